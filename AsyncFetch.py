@@ -0,0 +1,228 @@
+import asyncio  # Import for keeping many file fetches in flight on one connection
+from concurrent.futures import ThreadPoolExecutor
+from smbprotocol.open import Open, FilePipePrinterAccessMask
+from smbprotocol.exceptions import SMBConnectionClosed, EndOfFile, ObjectNameNotFound, ObjectPathNotFound
+import time
+import PerfStats  # Import for timing the requests
+
+# A read is charged one credit per 64 KiB requested
+credit_size = 65536
+
+# Most credits to ask the server for in one go
+max_credit_request = 8192
+
+def is_connection_broken(tree, error):
+    """
+    Check whether an error means the connection under a tree connect is gone (rather than one file failing).
+    """
+    transport = getattr(tree.session.connection, "transport", None)
+    return isinstance(error, SMBConnectionClosed) or (transport is not None and not transport.connected)
+
+def is_file_missing(error):
+    """
+    Check whether an error means the file (or a folder on its path) does not exist, rather than failing to be read.
+    """
+    return isinstance(error, (ObjectNameNotFound, ObjectPathNotFound))
+
+def get_available_credits(connection):
+    """
+    Return the number of credits the connection can still spend on new requests.
+    """
+    with connection.sequence_lock:
+        return connection.sequence_window["high"] - connection.sequence_window["low"]
+
+def get_read_length(connection, size):
+    """
+    Return the length to ask for when reading a file of a listed size in one request: the size rounded up to
+    the next credit boundary (so a file that grew a little is still read whole for the same credits), capped
+    at the maximum read size.
+    """
+    return min(connection.max_read_size, (size // credit_size + 1) * credit_size)
+
+def get_fetch_credits(connection, size):
+    """
+    Return the credits a compound fetch (see send_fetch) of a file of a listed size costs.
+    """
+    if size == 0:
+        return 2
+    return 2 + (get_read_length(connection, size) - 1) // credit_size + 1
+
+def send_fetch(tree, file_path, size):
+    """
+    Send the create, read and close of a file as one related compound request, so fetching a small file
+    takes a single round trip. Files listed as empty are only opened and closed.
+
+    Returns:
+        tuple: (file, receive functions, requests) to pass to receive_fetch.
+    """
+    file = Open(tree, file_path)
+    steps = [file.create(
+        desired_access=FilePipePrinterAccessMask.GENERIC_READ,
+        impersonation_level=0,
+        file_attributes=0,
+        share_access=1,
+        create_disposition=1,
+        create_options=0,
+        send=False
+    )]
+    if size > 0:
+        steps.append(file.read(0, get_read_length(tree.session.connection, size), send=False))
+    steps.append(file.close(send=False))
+
+    requests = tree.session.connection.send_compound([message for message, _ in steps], tree.session.session_id,
+                                                     tree.tree_connect_id, related=True)
+    return file, [receive for _, receive in steps], requests
+
+def receive_fetch(tree, file_path, file, receivers, requests):
+    """
+    Wait for the responses of a compound fetch and return the content of the file. Every response is
+    collected, even after an error. If the file is bigger than the compound read (it grew since it was
+    listed, or is larger than one read), the rest is read separately.
+
+    Returns:
+        bytes: The content of the file.
+    """
+    results = []
+    for receive, request in zip(receivers, requests):
+        try:
+            results.append((receive(request), None))
+        except Exception as e:
+            results.append((None, e))
+
+    create_error = results[0][1]
+    if create_error is not None:
+        raise create_error
+
+    # A server may fail the close along with a failed read, in which case the file is closed on its own
+    close_error = results[-1][1]
+    if close_error is not None:
+        if is_connection_broken(tree, close_error):
+            raise close_error
+        file.close()
+
+    data = b""
+    if len(results) == 3:
+        data, read_error = results[1]
+        if isinstance(read_error, EndOfFile):
+            data = b""  # The file was emptied since it was listed
+        elif read_error is not None:
+            raise read_error
+
+    if file.end_of_file > len(data):
+        data += read_rest(tree, file_path, len(data))
+    return data
+
+def read_rest(tree, file_path, offset):
+    """
+    Read a file from an offset to its end with one request at a time.
+    """
+    connection = tree.session.connection
+    file = Open(tree, file_path)
+    file.create(
+        desired_access=FilePipePrinterAccessMask.GENERIC_READ,
+        impersonation_level=0,
+        file_attributes=0,
+        share_access=1,
+        create_disposition=1,
+        create_options=0
+    )
+    chunks = []
+    try:
+        while offset < file.end_of_file:
+            with PerfStats.timer("smb_read"):
+                chunk = file.read(offset, min(connection.max_read_size, file.end_of_file - offset))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+    finally:
+        file.close()
+    return b"".join(chunks)
+
+async def fetch_files(tree, day_files, output_file, concurrency, on_file=None, on_missing=None):
+    """
+    Fetch day files on one connection with up to `concurrency` of them in flight at once, each in one
+    round trip, and write them to the output file in order.
+
+    The requests are sent from the event loop, and their responses are collected by a single thread in the
+    order they were sent, so each file is written as soon as it and every file before it have arrived.
+    Files that no longer exist (removed since the listing) are skipped. Fetching stops at the first file
+    that fails any other way, such as a failed read or a broken connection, leaving the rest to the caller.
+
+    Args:
+        tree (TreeConnect): The tree connect to fetch over.
+        day_files (list): Date-sorted (date, remote path, size, last write) of the files to fetch.
+        output_file (file): Binary file the content of the files is appended to.
+        concurrency (int): Most files in flight at once.
+        on_file (function): Called with (day file, bytes written) after each file is written.
+        on_missing (function): Called with (day file, error) for each file skipped because it no longer exists.
+
+    Returns:
+        int: The number of day files handled (written or skipped), from the start of the list.
+    """
+    loop = asyncio.get_running_loop()
+    connection = tree.session.connection
+    slots = asyncio.Semaphore(concurrency)
+    credits_returned = asyncio.Condition()
+    in_flight = 0
+
+    with ThreadPoolExecutor(max_workers=1) as collector:
+        # Ask the server for enough credits to keep the first files in flight (with fewer, fewer are sent at once)
+        wanted_credits = sum(get_fetch_credits(connection, size) for _, _, size, _ in day_files[:concurrency])
+        if get_available_credits(connection) < wanted_credits:
+            try:
+                await loop.run_in_executor(collector, lambda: connection.echo(
+                    sid=tree.session.session_id, credit_request=min(wanted_credits, max_credit_request)))
+            except Exception:
+                pass
+
+        async def fetch(day_file):
+            nonlocal in_flight
+            _, file_path, size, _ = day_file
+            async with slots:
+                needed_credits = get_fetch_credits(connection, size)
+                async with credits_returned:
+                    # Wait for earlier files to give back their credits if there are not enough left
+                    await credits_returned.wait_for(lambda: in_flight == 0 or get_available_credits(connection) >= needed_credits)
+                    sent_at = time.perf_counter()
+                    sent = send_fetch(tree, file_path, size)
+                    in_flight += 1
+                try:
+                    data = await loop.run_in_executor(collector, receive_fetch, tree, file_path, *sent)
+                    PerfStats.record("smb_compound_fetch", time.perf_counter() - sent_at)
+                    return data
+                finally:
+                    async with credits_returned:
+                        in_flight -= 1
+                        credits_returned.notify_all()
+
+        tasks = [asyncio.ensure_future(fetch(day_file)) for day_file in day_files]
+        handled = 0
+        try:
+            for day_file, task in zip(day_files, tasks):
+                try:
+                    data = await task
+                except Exception as e:
+                    if not is_file_missing(e):
+                        break  # Leave this file and the rest to the caller
+                    handled += 1
+                    if on_missing is not None:
+                        on_missing(day_file, e)
+                    continue  # Skip files removed since the listing
+
+                output_file.write(data)
+                handled += 1
+                if on_file is not None:
+                    on_file(day_file, len(data))
+        finally:
+            # Stop sending; the collector still takes in the responses of anything already sent
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return handled
+
+def fetch_files_in_order(tree, day_files, output_file, concurrency, on_file=None, on_missing=None):
+    """
+    Run fetch_files (see above) on an event loop of its own, for calling from a worker thread.
+    """
+    return asyncio.run(fetch_files(tree, day_files, output_file, concurrency, on_file, on_missing))
@@ -0,0 +1,362 @@
+import os
+import sys
+import json  # Import for passing scenario results back from the child processes
+import time
+import random  # Import for the synthetic session data
+import shutil
+import argparse
+import subprocess  # Import for running each scenario in a process of its own (so its peak memory is its own)
+from datetime import date, timedelta
+
+# resource (peak memory) is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Time the scripts on synthetic data, without the real server:
+#   python Benchmark.py [--scale small|medium|large] [--latency seconds] [--scenarios merge,search_scan,...]
+# A synthetic "Data Backup" tree is served through FakeSMB for the merger, and synthetic merged box files are
+# searched and exported by IDFinder. Each scenario reports files/s, MB/s and peak memory (RSS).
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Size of the synthetic data: rooms and box ranges, years of day files, the chance of a day having a file,
+# and how many sessions (animals) a day file holds
+scales = {
+    "small": {"rooms": {"G126": ["1-16", "1B-16B"]}, "years": 2, "day_chance": 0.5, "sessions": (1, 8), "subjects": 60},
+    "medium": {"rooms": {"G126": ["1-16", "1B-16B"], "G138": ["1-16", "1B-16B"], "G140": ["1-16", "1B-14B"]},
+               "years": 5, "day_chance": 0.7, "sessions": (1, 12), "subjects": 300},
+    "large": {"rooms": {"G126": ["1-16", "1B-16B"], "G138": ["1-16", "1B-16B"], "G140": ["1-16", "1B-14B"]},
+              "years": 10, "day_chance": 0.9, "sessions": (4, 16), "subjects": 1000},
+}
+
+# Scenarios in the order they run
+scenario_names = ["merge", "merge_incremental", "index_build", "search_index", "search_scan", "search_filtered", "excel_export"]
+
+# Number of IDs looked up by the search scenarios
+search_id_count = 20
+
+def session_block(rng, session_date, subject, box):
+    """
+    Build one MED-PC session block: the header lines, a few variables and an array, ending with a blank line.
+    """
+    start_minutes = rng.randint(8 * 60, 16 * 60)
+    lines = [
+        f"Start Date: {session_date:%m/%d/%y}",
+        f"End Date: {session_date:%m/%d/%y}",
+        f"Subject: {subject}",
+        f"Experiment: {rng.choice(['FR1', 'FR5', 'PR', 'EXT'])}",
+        f"Group: {rng.randint(1, 4)}",
+        f"Box: {box}",
+        f"Start Time: {start_minutes // 60}:{start_minutes % 60:02d}:{rng.randint(0, 59):02d}",
+        f"End Time: {start_minutes // 60 + 1}:{start_minutes % 60:02d}:{rng.randint(0, 59):02d}",
+        f"MSN: {rng.choice(['FR1_Training', 'FR5_Cocaine', 'PR_Sucrose', 'Extinction'])}",
+    ]
+    for variable in "ABDEF":
+        lines.append(f"{variable}: {rng.randint(0, 500):>11.3f}")
+
+    # Arrays are written five values to a row, each row starting with the index of its first value
+    for variable in "CGH":
+        values = [rng.random() * 1000 for _ in range(rng.randint(5, 60))]
+        lines.append(f"{variable}:")
+        for index in range(0, len(values), 5):
+            lines.append(f"{index:>6}:" + "".join(f"{value:>13.3f}" for value in values[index:index + 5]))
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+def day_file(rng, session_date, subjects, box_range):
+    """
+    Build the content of one day file ("!YYYY-MM-DD") of a box range: a "File:" line and one session per subject.
+    """
+    first_box, last_box = (int("".join(c for c in box if c.isdigit())) for box in box_range.split("-"))
+    blocks = [f"File: C:\\MED-PC\\Data\\!{session_date:%Y-%m-%d}\r\n\r\n"]
+    for subject in subjects:
+        blocks.append(session_block(rng, session_date, subject, rng.randint(first_box, last_box)))
+    return "".join(blocks).encode("utf-8")
+
+def generate_day_files(scale, seed):
+    """
+    Generate the day files of every room and box range at a scale, in date order.
+
+    Yields:
+        tuple: (room, box range, session date, content).
+    """
+    rng = random.Random(seed)
+    first_year = date.today().year - scale["years"]
+    subjects = [str(4000 + i) for i in range(scale["subjects"])]
+    for room, box_ranges in scale["rooms"].items():
+        for box_range in box_ranges:
+            session_date = date(first_year, 1, 1)
+            while session_date.year < date.today().year:
+                if rng.random() < scale["day_chance"]:
+                    day_subjects = rng.sample(subjects, rng.randint(*scale["sessions"]))
+                    yield room, box_range, session_date, day_file(rng, session_date, day_subjects, box_range)
+                session_date += timedelta(days=1)
+
+def generate_backup_tree(share_folder, scale, seed=1):
+    """
+    Write a synthetic "WLynch_Labs/Data Backup/<room>/<box range>/<year>/!YYYY-MM-DD" tree for FakeSMB to serve.
+
+    Returns:
+        tuple: (number of day files, total bytes).
+    """
+    files = 0
+    total_bytes = 0
+    for room, box_range, session_date, content in generate_day_files(scale, seed):
+        year_path = os.path.join(share_folder, "WLynch_Labs", "Data Backup", room, box_range, str(session_date.year))
+        os.makedirs(year_path, exist_ok=True)
+        with open(os.path.join(year_path, f"!{session_date:%Y-%m-%d}"), "wb") as f:
+            f.write(content)
+        files += 1
+        total_bytes += len(content)
+    return files, total_bytes
+
+def generate_merged_files(data_folder, scale, seed=1):
+    """
+    Write synthetic merged box files ("<room>_<box range>.txt", the day files one after another) for IDFinder.
+
+    Returns:
+        tuple: (number of box files, total bytes).
+    """
+    os.makedirs(data_folder, exist_ok=True)
+    box_files = {}
+    total_bytes = 0
+    try:
+        for room, box_range, _, content in generate_day_files(scale, seed):
+            box_name = f"{room}_{box_range}"
+            if box_name not in box_files:
+                box_files[box_name] = open(os.path.join(data_folder, f"{box_name}.txt"), "wb")
+            box_files[box_name].write(content)
+            total_bytes += len(content)
+    finally:
+        for box_file in box_files.values():
+            box_file.close()
+    return len(box_files), total_bytes
+
+def get_peak_rss_mb():
+    """
+    Return the peak resident memory of this process and its finished child processes in MB, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def get_folder_size(folder):
+    """
+    Return the number of files in a folder (hidden files left out) and their total size in bytes.
+    """
+    files = 0
+    total_bytes = 0
+    for root, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            if not file_name.startswith("."):
+                files += 1
+                total_bytes += os.path.getsize(os.path.join(root, file_name))
+    return files, total_bytes
+
+def get_search_ids(scale):
+    """
+    Pick the IDs the search scenarios look up: mostly subjects in the data, plus a few that are not.
+    """
+    rng = random.Random(0)
+    ids = rng.sample([str(4000 + i) for i in range(scale["subjects"])], min(search_id_count, scale["subjects"]))
+    return ids + ["9999", "ABC-1"]
+
+def run_merge(bench_folder, latency):
+    """
+    Run DataMergerComplete (copied into the benchmark folder, where it writes its results) against the
+    synthetic tree served by FakeSMB. Its prompts are answered from stdin.
+
+    Returns:
+        tuple: (files, bytes) fetched by the run, from the merger's own counters (see PerfStats).
+    """
+    scripts_folder = os.path.join(bench_folder, "scripts")
+    sys.path.insert(0, scripts_folder)
+    import FakeSMB
+    import getpass
+    import runpy
+    FakeSMB.install(os.path.join(bench_folder, "share"), latency)
+    getpass.getpass = lambda prompt="": input(prompt)
+    os.system = lambda command: 0  # No alert sound
+    runpy.run_path(os.path.join(scripts_folder, "DataMergerComplete.py"), run_name="__main__")
+
+    # The merger counts what it fetched in the PerfStats module it imported from the scripts folder
+    import PerfStats
+    fetched_bytes = sum(amount for name, (amount, _) in PerfStats.throughputs.items() if name.startswith("box_bytes."))
+    return PerfStats.counters.get("files_fetched", 0), fetched_bytes
+
+def run_search(bench_folder, scale, scenario):
+    """
+    Run one of the IDFinder scenarios on the synthetic merged box files.
+
+    Returns:
+        tuple: (files, bytes) processed: the whole folder for the index build and the text search, the files
+        and session blocks read for the index search, and the files and bytes searched for the filtered search.
+    """
+    import IDFinder
+    import IDIndex
+    data_folder = os.path.join(bench_folder, "Data")
+    search_ids = get_search_ids(scale)
+    files, total_bytes = get_folder_size(data_folder)
+
+    if scenario == "index_build":
+        index_path = IDIndex.get_index_path(data_folder)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        IDIndex.update_index(data_folder)
+    elif scenario == "search_index":
+        read_files = set()
+        total_bytes = 0
+        for files_by_id in IDIndex.lookup_ids(data_folder, search_ids).values():
+            IDFinder.read_indexed_contexts(files_by_id)
+            read_files.update(files_by_id)
+            total_bytes += sum(length for blocks in files_by_id.values() for _, length in blocks)
+        files = len(read_files)
+    elif scenario == "search_scan":
+        IDFinder.search_ids_in_files_with_context(data_folder, search_ids)
+    elif scenario == "search_filtered":
+        # A targeted query: the last month of data in one box of the first room. Only the text of the sessions
+        # in that month is searched, so the files and bytes reported are those searched
+        room = next(iter(scale["rooms"]))
+        file_paths = [os.path.join(data_folder, rel_path) for rel_path in IDIndex.list_data_files(data_folder)
+                      if IDFinder.is_file_selected(rel_path, [room], ["3"])]
+        end_date = date(date.today().year - 1, 12, 31)
+        start_date = end_date - timedelta(days=30)
+        files, total_bytes = 0, 0
+        for file_path, sessions in IDIndex.lookup_sessions(data_folder, file_paths).items():
+            regions = IDFinder.get_date_regions(sessions, start_date.isoformat(), end_date.isoformat())
+            IDFinder.search_ids_in_file_with_context(file_path, search_ids, regions)
+            files += 1 if regions else 0
+            total_bytes += sum((end if end is not None else sessions[-1][0] + sessions[-1][1]) - start for start, end in regions)
+    return files, total_bytes
+
+def run_excel_export(bench_folder, scale):
+    """
+    Time writing the Excel files of the search IDs (the contexts are found first, outside the timing).
+    """
+    import IDFinder
+    output_folder = os.path.join(bench_folder, "Results")
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
+    os.makedirs(output_folder)
+    results = IDFinder.search_ids_in_files_with_context(os.path.join(bench_folder, "Data"), get_search_ids(scale))
+
+    start = time.perf_counter()
+    for search_string, files_by_id in results.items():
+        for file_path, contexts in files_by_id.items():
+            IDFinder.write_contexts_workbook(contexts, IDFinder.get_output_file_path(output_folder, search_string, file_path))
+    seconds = time.perf_counter() - start
+    files, total_bytes = get_folder_size(output_folder)
+    return files, total_bytes, seconds
+
+def run_scenario(scenario, bench_folder, scale_name, latency):
+    """
+    Run one scenario in this process and print its result as a JSON line (called in a child process).
+    """
+    scale = scales[scale_name]
+    start = time.perf_counter()
+    if scenario in ("merge", "merge_incremental"):
+        files, total_bytes = run_merge(bench_folder, latency)
+        seconds = time.perf_counter() - start
+    elif scenario == "excel_export":
+        files, total_bytes, seconds = run_excel_export(bench_folder, scale)
+    else:
+        files, total_bytes = run_search(bench_folder, scale, scenario)
+        seconds = time.perf_counter() - start
+
+    result = {"scenario": scenario, "files": files, "bytes": total_bytes, "seconds": seconds, "peak_rss_mb": get_peak_rss_mb()}
+    if scenario in ("search_index", "search_scan", "search_filtered"):
+        result["seconds_per_id"] = seconds / len(get_search_ids(scale))
+    print("BENCHMARK_RESULT " + json.dumps(result))
+
+def prepare_bench_folder(bench_folder, scale_name):
+    """
+    Generate the synthetic data in the benchmark folder and copy the scripts into it, unless the data
+    for this scale is already there.
+    """
+    marker_path = os.path.join(bench_folder, "scale.txt")
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as marker_file:
+            if marker_file.read().strip() == scale_name:
+                print(f"Reusing the synthetic data in '{bench_folder}'.")
+                return
+    if os.path.exists(bench_folder):
+        shutil.rmtree(bench_folder)
+
+    scale = scales[scale_name]
+    print(f"Generating {scale_name} synthetic data in '{bench_folder}'...")
+    day_files, day_bytes = generate_backup_tree(os.path.join(bench_folder, "share"), scale)
+    box_files, box_bytes = generate_merged_files(os.path.join(bench_folder, "Data"), scale)
+    print(f"{day_files} day files ({day_bytes / (1024 * 1024):.1f} MB), {box_files} merged box files ({box_bytes / (1024 * 1024):.1f} MB).")
+
+    # The merger runs from its own folder (it writes its results and caches next to the script)
+    scripts_folder = os.path.join(bench_folder, "scripts")
+    os.makedirs(scripts_folder)
+    for file_name in os.listdir(script_dir):
+        if file_name.endswith(".py"):
+            shutil.copy(os.path.join(script_dir, file_name), scripts_folder)
+    with open(os.path.join(scripts_folder, "Room Config.json"), "w", encoding="utf-8") as room_config_file:
+        json.dump(scale["rooms"], room_config_file)
+
+    with open(marker_path, "w", encoding="utf-8") as marker_file:
+        marker_file.write(scale_name)
+
+def print_results(results):
+    """
+    Print the scenario results as a table.
+    """
+    print(f"\n{'Scenario':<20}{'Files':>8}{'MB':>9}{'Seconds':>10}{'Files/s':>10}{'MB/s':>9}{'Peak RSS (MB)':>15}")
+    for result in results:
+        megabytes = result["bytes"] / (1024 * 1024)
+        seconds = max(result["seconds"], 1e-9)
+        peak_rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "n/a"
+        print(f"{result['scenario']:<20}{result['files']:>8}{megabytes:>9.1f}{result['seconds']:>10.2f}"
+              f"{result['files'] / seconds:>10.1f}{megabytes / seconds:>9.1f}{peak_rss:>15}")
+        if "seconds_per_id" in result:
+            print(f"{'':<20}{result['seconds_per_id'] * 1000:.1f} ms per ID")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the merger and IDFinder on synthetic data.")
+    parser.add_argument("--scale", choices=list(scales), default="small", help="Size of the synthetic data")
+    parser.add_argument("--folder", default=os.path.join(script_dir, "Benchmark Data"), help="Folder for the synthetic data and results")
+    parser.add_argument("--latency", type=float, default=0.002, help="Simulated SMB round trip in seconds")
+    parser.add_argument("--scenarios", default=",".join(scenario_names), help="Comma-separated scenarios to run")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the scripts")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    bench_folder = os.path.abspath(args.folder)
+    if args.child:
+        run_scenario(args.child, bench_folder, args.scale, args.latency)
+        sys.exit(0)
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    unknown_scenarios = [scenario for scenario in scenarios if scenario not in scenario_names]
+    if unknown_scenarios:
+        print(f"Error: Unknown scenario(s) {', '.join(unknown_scenarios)}. Choose from {', '.join(scenario_names)}.")
+        sys.exit(1)
+
+    prepare_bench_folder(bench_folder, args.scale)
+
+    # Each scenario runs in a fresh process so its time and peak memory are its own
+    results = []
+    for scenario in scenarios:
+        print(f"Running {scenario}...")
+        command = [sys.executable, os.path.abspath(__file__), "--child", scenario, "--folder", bench_folder,
+                   "--scale", args.scale, "--latency", str(args.latency)]
+        # Answers to the merger's prompts: username, password, and whether to fetch only new files
+        answers = f"bench\nbench\n{'y' if scenario == 'merge_incremental' else 'n'}\n"
+        output = None if args.verbose else subprocess.DEVNULL
+        process = subprocess.run(command, input=answers, stdout=subprocess.PIPE, stderr=output, text=True)
+        lines = [line for line in process.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+        if process.returncode != 0 or not lines:
+            print(f"Error: The {scenario} scenario failed (exit code {process.returncode}).")
+            continue
+        if args.verbose:
+            print("\n".join(line for line in process.stdout.splitlines() if not line.startswith("BENCHMARK_RESULT ")))
+        results.append(json.loads(lines[-1][len("BENCHMARK_RESULT "):]))
+
+    print_results(results)
@@ -0,0 +1,223 @@
+import os
+import re  # Import for finding the session block boundaries to cut frames at
+import json  # Import for the frame lists
+import mmap  # Import for reading part files without loading them into memory
+from bisect import bisect_right
+import IDIndex  # Import for finding the context of a match
+import FileUtils  # Import for saving the frame sidecars safely
+
+# zstandard is optional: without it the merged files are only written as plain text
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A compressed merged file ("<box>.txt.zst") is a series of independent zstd frames, each holding whole day files
+# or session blocks, so any frame can be decompressed on its own. A hidden sidecar (".<box>.txt.zst.frames.json") lists every frame
+# with its position in the file and in the uncompressed text, so a search of some parts of the text (e.g. the sessions
+# of a date range) or a read of some blocks only decompresses the frames holding them.
+
+# Suffix of compressed merged files
+compressed_suffix = ".zst"
+
+# Uncompressed bytes per frame (frames are cut at the next day file or session block after this many bytes)
+frame_size = 1024 * 1024
+
+# zstd compression level (the merged text is very repetitive, so higher levels pay off)
+compression_level = 10
+
+# A blank line followed by the start of a day file or a session block, where a frame can end
+frame_end_pattern = re.compile(rb"\n[ \t\r\f\v]*\n(?=File:|Start Date:)")
+
+# Bytes read at a time when the frames of a file are listed without a sidecar
+scan_chunk_size = 1024 * 1024
+
+def is_available():
+    """
+    Check whether zstandard is installed so compressed files can be written and read.
+    """
+    return zstandard is not None
+
+def is_compressed(file_path):
+    """
+    Check whether a merged file is compressed (by its name).
+    """
+    return file_path.endswith(compressed_suffix)
+
+def get_frames_path(file_path):
+    """
+    Return the path of the (hidden) frame sidecar of a compressed merged file.
+    """
+    folder, file_name = os.path.split(file_path)
+    return os.path.join(folder, f".{file_name}.frames.json")
+
+def load_frames(file_path):
+    """
+    Load the frame list of a compressed merged file. If the sidecar is missing or does not match the file
+    (e.g. a run stopped between writing the two), the frames are listed from the file itself and the sidecar
+    is written again.
+
+    Returns:
+        list: One dictionary per frame with the keys "offset" and "length" (in the file) and "start" and "size"
+        (in the uncompressed text).
+    """
+    if zstandard is None:
+        raise ValueError(f"zstandard is not installed, the compressed file '{file_path}' cannot be read")
+
+    try:
+        with open(get_frames_path(file_path), "r", encoding="utf-8") as frames_file:
+            frames = json.load(frames_file)
+        if sum(frame["length"] for frame in frames) == os.path.getsize(file_path):
+            return frames
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    frames = scan_frames(file_path)
+    save_frames(file_path, frames)
+    return frames
+
+def save_frames(file_path, frames):
+    """
+    Save the frame list of a compressed merged file.
+    """
+    FileUtils.write_json_file(get_frames_path(file_path), frames)
+
+def scan_frames(file_path):
+    """
+    List the frames of a compressed merged file by decompressing it frame by frame.
+    """
+    frames = []
+    offset = 0
+    start = 0
+    with open(file_path, "rb") as f:
+        pending = b""
+        while True:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+            chunks = []
+            consumed = 0
+            while not decompressor.eof:
+                if not pending:
+                    pending = f.read(scan_chunk_size)
+                    if not pending:
+                        break
+                try:
+                    chunks.append(decompressor.decompress(pending))
+                except zstandard.ZstdError as e:
+                    raise ValueError(f"The compressed file '{file_path}' is corrupt at offset {offset}: {e}")
+                consumed += len(pending) - len(decompressor.unused_data)
+                pending = decompressor.unused_data
+            if not decompressor.eof:
+                break  # End of the file (or a frame cut short)
+
+            data = b"".join(chunks)
+            frames.append({"offset": offset, "length": consumed, "start": start, "size": len(data)})
+            offset += consumed
+            start += len(data)
+    return frames
+
+def append_file(file_path, source_path):
+    """
+    Compress a plain merged file (such as a year part file) onto the end of a compressed merged file, cutting
+    a new frame at the first day file or session block after every frame_size bytes, and update the sidecar.
+
+    Returns:
+        int: The number of compressed bytes written.
+    """
+    frames = load_frames(file_path) if os.path.exists(file_path) else []
+    offset = sum(frame["length"] for frame in frames)
+    start = sum(frame["size"] for frame in frames)
+    compressor = zstandard.ZstdCompressor(level=compression_level, write_content_size=True)
+    written = 0
+
+    if os.path.getsize(source_path) > 0:
+        with open(source_path, "rb") as source_file, mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                open(file_path, "ab") as compressed_file:
+            position = 0
+            while position < len(data):
+                frame_end = frame_end_pattern.search(data, min(position + frame_size, len(data)))
+                end = frame_end.end() if frame_end else len(data)
+                frame_data = data[position:end]
+                compressed = compressor.compress(frame_data)
+                compressed_file.write(compressed)
+                frames.append({"offset": offset, "length": len(compressed), "start": start, "size": len(frame_data)})
+                offset += len(compressed)
+                start += len(frame_data)
+                written += len(compressed)
+                position = end
+
+    save_frames(file_path, frames)
+    return written
+
+def remove(file_path):
+    """
+    Remove a compressed merged file and its sidecar, if they exist.
+    """
+    for path in (file_path, get_frames_path(file_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def read_frame(f, frame):
+    """
+    Read and decompress one frame from an open (binary) compressed file.
+    """
+    f.seek(frame["offset"])
+    try:
+        return zstandard.ZstdDecompressor().decompress(f.read(frame["length"]))
+    except zstandard.ZstdError as e:
+        raise ValueError(f"The frame at offset {frame['offset']} of '{f.name}' is corrupt: {e}")
+
+def iter_frames(file_path, regions=None, with_lead=False):
+    """
+    Decompress the frames of a compressed merged file one at a time. With regions ((start, end) ranges of the
+    uncompressed text, end None for the end of the file), frames outside all of them are skipped.
+
+    With with_lead, each frame comes with the last two lines of the text before it (the "lead"), so a match
+    on the first lines of a frame gets the same context as in the plain file; the frame before is
+    decompressed for it if it was skipped.
+
+    Yields:
+        tuple: (frame, uncompressed text of the frame, lead), the lead being b"" without with_lead.
+    """
+    frames = load_frames(file_path)
+    with open(file_path, "rb") as f:
+        previous_index = None
+        previous_data = b""
+        for index, frame in enumerate(frames):
+            if regions is not None and not any(start < frame["start"] + frame["size"] and (end is None or end > frame["start"])
+                                               for start, end in regions):
+                continue  # The frame is outside the regions searched
+
+            data = read_frame(f, frame)
+            lead = b""
+            if with_lead and index > 0:
+                if previous_index != index - 1:
+                    previous_data = read_frame(f, frames[index - 1])
+                lead = previous_data[IDIndex.find_block(previous_data, len(previous_data))[0]:]
+            yield frame, data, lead
+            previous_index, previous_data = index, data
+
+def read_blocks(file_path, blocks):
+    """
+    Read ranges of the uncompressed text of a compressed merged file, decompressing each frame needed once.
+
+    Args:
+        file_path (str): Path to the compressed merged file.
+        blocks (list): (offset, length) tuples in the uncompressed text, each within one frame.
+
+    Returns:
+        list: The bytes of each range.
+    """
+    frames = load_frames(file_path)
+    frame_starts = [frame["start"] for frame in frames]
+    results = []
+    current_frame = None
+    frame_data = b""
+    with open(file_path, "rb") as f:
+        for offset, length in blocks:
+            frame = frames[bisect_right(frame_starts, offset) - 1]
+            if frame is not current_frame:
+                current_frame = frame
+                frame_data = read_frame(f, frame)
+            local_offset = offset - frame["start"]
+            results.append(frame_data[local_offset:local_offset + length])
+    return results
@@ -0,0 +1,174 @@
+from datetime import datetime  # Import for date parsing
+from functools import lru_cache
+
+# NumPy is optional: without it the lines are converted and measured one value at a time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Turns the context blocks found for an ID into spreadsheet rows: each line is split into columns by spaces, the
+# date in the first two lines of a block ("Start Date:"/"End Date:") is written as MM/DD/YYYY, and on the other
+# lines values made only of digits become integers, other numbers floats and the rest stays text. Array lines
+# are converted a whole line at a time, and the column widths are worked out with NumPy.
+
+# Date formats used in the "Start Date:" and "End Date:" lines
+date_formats = ["%m/%d/%y", "%d-%m-%Y"]
+
+# Format the last date was in, tried first for the next one
+detected_date_format = None
+
+def is_available():
+    """
+    Check whether NumPy is installed so the column widths can be worked out in bulk.
+    """
+    return np is not None
+
+@lru_cache(maxsize=4096)
+def format_date(date_str):
+    """
+    Rewrite a session date as MM/DD/YYYY, or return None if it is in none of the known formats.
+    The formats do not overlap, so trying the one that matched last first gives the same result.
+    """
+    global detected_date_format
+    for fmt in ([detected_date_format] if detected_date_format else []) + date_formats:
+        try:
+            date = datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+        detected_date_format = fmt
+        return date.strftime("%m/%d/%Y")
+    return None
+
+def convert_date_line(line):
+    """
+    Split a "Start Date:"/"End Date:" line into columns, with the date rewritten as MM/DD/YYYY.
+    """
+    columns = line.split()
+    if len(columns) > 2:
+        date_str = format_date(columns[2])
+        if date_str:
+            columns[2] = date_str
+    return columns
+
+def convert_value(value):
+    """
+    Convert one value the way every value of a data line is converted: digits only to an integer,
+    any other number to a float, and anything else is left as text.
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def convert_lines_one_by_one(lines):
+    """
+    Split data lines into columns and convert each value with convert_value.
+
+    Returns:
+        tuple: (rows, column widths) where the width of a column is the length of its longest
+        non-empty value (zeros are left out).
+    """
+    rows = []
+    column_widths = []
+    for line in lines:
+        columns = [convert_value(value) for value in line.split()]
+        if len(columns) > len(column_widths):
+            column_widths.extend([0] * (len(columns) - len(column_widths)))
+        for i, value in enumerate(columns):
+            if value:
+                column_widths[i] = max(column_widths[i], len(str(value)))
+        rows.append(columns)
+    return rows, column_widths
+
+def convert_lines(lines):
+    """
+    Split data lines into columns and convert the values as convert_value would, a line at a time where
+    possible. The array lines of a block ("label: 1.000 2.000 ...") hold one decimal point per value, so
+    none of the values is a plain integer and the whole line is converted with float() in one go; other
+    lines are converted one value at a time. The widths of the columns are then worked out with NumPy
+    from the distinct values in each column, instead of turning every value back into text.
+
+    Returns:
+        tuple: (rows, column widths), as for convert_lines_one_by_one.
+    """
+    if np is None:
+        return convert_lines_one_by_one(lines)
+
+    rows = []
+    column_widths = []
+    numbers = []  # The values of the array lines, in order
+    number_counts = []  # Number of values in each array line
+    for line in lines:
+        columns = line.split()
+        label = columns[0] if columns else ""
+        if label.endswith(":") and line.count(".") - label.count(".") == len(columns) - 1:
+            try:
+                values = list(map(float, columns[1:]))
+            except ValueError:
+                pass  # Not every value is a number
+            else:
+                columns[1:] = values
+                numbers.extend(values)
+                number_counts.append(len(values))
+                rows.append(columns)
+                # The label is the only text in the line, the values are measured below
+                if not column_widths:
+                    column_widths.append(0)
+                column_widths[0] = max(column_widths[0], len(label))
+                continue
+
+        row, widths = convert_lines_one_by_one([line])
+        if len(widths) > len(column_widths):
+            column_widths.extend([0] * (len(widths) - len(column_widths)))
+        for i, width in enumerate(widths):
+            column_widths[i] = max(column_widths[i], width)
+        rows.extend(row)
+
+    if numbers:
+        # Column of each value (the label is column 0)
+        number_counts = np.array(number_counts)
+        numbers = np.array(numbers)
+        line_starts = np.repeat(np.cumsum(number_counts) - number_counts, number_counts)
+        columns = np.arange(len(numbers)) - line_starts + 1
+        if int(number_counts.max()) + 1 > len(column_widths):
+            column_widths.extend([0] * (int(number_counts.max()) + 1 - len(column_widths)))
+        for column in range(1, int(number_counts.max()) + 1):
+            for value in np.unique(numbers[columns == column]).tolist():
+                if value:
+                    column_widths[column] = max(column_widths[column], len(str(value)))
+    return rows, column_widths
+
+def get_rows(contexts):
+    """
+    Turn the context blocks found for an ID (lists of lines) into spreadsheet rows, one per line.
+
+    Returns:
+        tuple: (rows, column widths) where the width of a column is the length of its longest
+        non-empty value (zeros are left out).
+    """
+    date_rows = []
+    data_lines = []
+    is_date_line = []
+    for context in contexts:
+        for line_index, line in enumerate(context):
+            # The first two lines of a block hold the dates
+            is_date_line.append(line_index < 2)
+            if line_index < 2:
+                date_rows.append(convert_date_line(line))
+            else:
+                data_lines.append(line)
+
+    data_rows, column_widths = convert_lines(data_lines)
+    for columns in date_rows:
+        if len(columns) > len(column_widths):
+            column_widths.extend([0] * (len(columns) - len(column_widths)))
+        for i, value in enumerate(columns):
+            column_widths[i] = max(column_widths[i], len(value))
+
+    date_rows = iter(date_rows)
+    data_rows = iter(data_rows)
+    rows = [next(date_rows) if date_line else next(data_rows) for date_line in is_date_line]
+    return rows, column_widths
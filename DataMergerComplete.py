@@ -4,15 +4,25 @@ from smbprotocol.tree import TreeConnect
 from smbprotocol.open import Open, FilePipePrinterAccessMask
 from smbprotocol.file_info import FileAttributes
 from smbprotocol.file_info import FileInformationClass
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from smbprotocol.exceptions import NoMoreFiles, SMBException
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from threading import Lock, local, current_thread
+from collections import deque  # Import for the queue of outstanding reads
 from tqdm import tqdm
 import getpass
 import shutil
 import os
 import uuid
 import re  # Import for regex to match folder names
+import json  # Import for the manifest of merged files
+import time
+import IDIndex  # Import for building the animal ID index of the merged files
+import SessionDataset  # Import for the columnar (Parquet) session dataset
+import AsyncFetch  # Import for fetching many small files at once on one connection
+import PerfStats  # Import for the timing counters and the performance report of the run
+import CompressedBox  # Import for writing the combined files compressed
+import FileUtils  # Import for saving the manifest, tree cache and checkpoints safely
 
 # Define server and credentials
 server = "topaz.storage.virginia.edu"
@@ -53,12 +63,41 @@ except Exception as e:
 # Automatically determine the number of threads based on CPU cores
 num_threads = os.cpu_count()
 
-# Input for chunk size in KB
-chunk_size = 32 * 1024  # Convert KB to bytes
+# Size of each read in bytes (capped at the maximum read size negotiated with the server)
+chunk_size = 1024 * 1024  # 1 MB
+
+# Number of reads kept outstanding per open file so the link stays busy while chunks are written out
+read_depth = 4
+
+# Day files each worker keeps in flight at once, each fetched in one round trip (set to 0 to fetch one file at a time)
+async_fetch_concurrency = 64
+
+# Times a failed request (other than for a missing file) is tried again, on a new connection and session after a delay
+# doubling from retry_delay seconds; a box whose files still fail is left unfinished and picked up by the next run
+retry_attempts = 4
+retry_delay = 1
+
+# Also parse the sessions as they are merged into a Parquet dataset partitioned by room, box range and year (needs pyarrow)
+write_session_dataset = True
+
+# Write the combined files as zstd frames ("<box>.txt.zst") instead of plain text (needs zstandard; IDFinder reads both)
+compress_output = False
+
+# Write a performance report (timings of the SMB requests, failed opens per box, bytes/s per worker) to the Reports folder
+write_performance_report = True
+
+# Profile the run as well when LYNCHLAB_PROFILE=1 is set (see PerfStats.py)
+PerfStats.start_profiling()
+
+# Leave out today's day files: MED-PC is still writing them during lab hours, and a merged file that grows
+# afterwards makes the next run write the whole box again. They are merged by the first run of the next day.
+skip_todays_files = True
 
 # Define the date range
 start_date = datetime(2014, 1, 1)  # Start date
 end_date = datetime.now().date()  # End date
+if skip_todays_files:
+    end_date -= timedelta(days=1)
 
 # Ensure the directory exists
 script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
@@ -67,40 +106,186 @@ script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of
 current_date_str = datetime.now().strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
 results_dir = os.path.join(script_dir, f"Data_{current_date_str}")
 
-# Delete all folders matching the pattern "Data_{any date}"
-for folder_name in os.listdir(script_dir):
-    if re.match(r"Data_\d{4}-\d{2}-\d{2}", folder_name):  # Match folders like "Data_YYYY-MM-DD"
-        folder_path = os.path.join(script_dir, folder_name)
-        if os.path.isdir(folder_path):
-            shutil.rmtree(folder_path)  # Delete the folder
-            print(f"Deleted old folder: {folder_path}")
+# Cache of the remote directory tree from the last run, used to skip listing folders that have not changed
+tree_cache_path = os.path.join(script_dir, ".smb_tree_cache.json")
+
+# Name of the manifest kept in the results folder, recording the size and last write time of every remote file merged so far
+manifest_file_name = ".merge_manifest.json"
+
+# Find the folders from earlier runs matching the pattern "Data_{any date}", newest first
+previous_dirs = sorted((folder_name for folder_name in os.listdir(script_dir)
+                        if re.match(r"Data_\d{4}-\d{2}-\d{2}", folder_name)  # Match folders like "Data_YYYY-MM-DD"
+                        and os.path.isdir(os.path.join(script_dir, folder_name))), reverse=True)
+
+# Offer an incremental run when the newest folder has a manifest: only new or changed files are fetched
+incremental_merge = False
+if previous_dirs and os.path.exists(os.path.join(script_dir, previous_dirs[0], manifest_file_name)):
+    answer = input(f"Fetch only new files since the last run into '{previous_dirs[0]}'? (Y/n): ").strip().lower()
+    incremental_merge = answer in ("", "y", "yes")
+
+merge_manifest = {}
+if incremental_merge:
+    # Keep the newest folder and bring it forward to today's name
+    kept_dir = os.path.join(script_dir, previous_dirs.pop(0))
+    if kept_dir != results_dir:
+        os.rename(kept_dir, results_dir)
+        print(f"Renamed folder '{kept_dir}' to '{results_dir}'.")
+    try:
+        with open(os.path.join(results_dir, manifest_file_name), "r", encoding="utf-8") as manifest_file:
+            merge_manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        print(f"Error reading the merge manifest, fetching all files again: {e}")
+
+# Delete all other folders matching the pattern "Data_{any date}"
+for folder_name in previous_dirs:
+    folder_path = os.path.join(script_dir, folder_name)
+    shutil.rmtree(folder_path)  # Delete the folder
+    print(f"Deleted old folder: {folder_path}")
+
+# Folder of the session dataset, kept across runs and updated along with the combined files
+dataset_dir = os.path.join(script_dir, "Sessions")
+if write_session_dataset and not SessionDataset.is_available():
+    print("pyarrow is not installed, the session dataset will not be written.")
+    write_session_dataset = False
+if write_session_dataset and not incremental_merge and os.path.isdir(dataset_dir):
+    shutil.rmtree(dataset_dir)  # Every box is written again from the start
+    print(f"Deleted old folder: {dataset_dir}")
+
+if compress_output and not CompressedBox.is_available():
+    print("zstandard is not installed, the combined files will be written as plain text.")
+    compress_output = False
 
 # Create the new results directory
 os.makedirs(results_dir, exist_ok=True)
 print(f"Output folder '{results_dir}' created.")
 
-# Variables for which files in the Data Backup folder to be combined
-room = ['G126', 'G138', 'G140'] #add more rooms as needed
-box = ['1-16', '1B-16B', '1-16', '1B-16B', '1-16', '1B-14B'] #if more boxes are added, add "1-16, 1B-16B"
+# The folder is only complete again once this run has finished (see IDServer.py)
+merge_complete_path = os.path.join(results_dir, IDIndex.merge_complete_file_name)
+if os.path.exists(merge_complete_path):
+    os.remove(merge_complete_path)
+
+# Remove part files left unfinished by an interrupted run (finished ones have a checkpoint and are reused)
+for file_name in os.listdir(results_dir):
+    file_path = os.path.join(results_dir, file_name)
+    if file_name.endswith(".part") and not os.path.exists(file_path + ".json"):
+        os.remove(file_path)
+    elif file_name.endswith((".part.json", ".part.json.tmp")) and not os.path.exists(file_path[:file_path.index(".part") + 5]):
+        os.remove(file_path)
+
+# Rooms and the box ranges in each room whose files in the Data Backup folder are combined
+rooms = {
+    'G126': ['1-16', '1B-16B'],
+    'G138': ['1-16', '1B-16B'],
+    'G140': ['1-16', '1B-14B'],
+}  # add more rooms and box ranges as needed
+
+# The rooms can also be set in "Room Config.json" next to the script, e.g. {"G126": ["1-16", "1B-16B"]}
+room_config_path = os.path.join(script_dir, "Room Config.json")
+if os.path.exists(room_config_path):
+    try:
+        with open(room_config_path, 'r', encoding='utf-8') as room_config_file:
+            rooms = json.load(room_config_file)
+        print(f"Rooms loaded from '{room_config_path}'.")
+    except (OSError, ValueError) as e:
+        print(f"Error reading '{room_config_path}', using the default rooms: {e}")
+
+# Lock for thread-safe manifest updates
+manifest_lock = Lock()
+
+# Each worker opens its own connection, session and tree connect, so workers don't share one socket and credit window
+worker_connection = local()
+worker_trees = []  # Every tree connect opened for a worker, for cleanup at the end
+worker_trees_lock = Lock()
+
+def connect_smb_tree():
+    """
+    Open a new authenticated connection, session and tree connect to the shared folder,
+    using the credentials entered at startup.
+    """
+    worker_conn = Connection(guid=uuid.uuid4(), server_name=server, port=445)
+    worker_conn.connect()
+    worker_session = Session(worker_conn, username, password)
+    worker_session.connect()
+    worker_tree = TreeConnect(worker_session, f"\\\\{server}\\{share}")
+    worker_tree.connect()
+    return worker_tree
+
+def disconnect_smb_tree(tree):
+    """
+    Close a tree connect together with its session and connection, ignoring errors from a connection that already broke.
+    """
+    for disconnect in (tree.disconnect, tree.session.disconnect, tree.session.connection.disconnect):
+        try:
+            disconnect()
+        except Exception:
+            pass
 
-# Loop through each date in the range
-current_date = start_date.date()
+def is_smb_tree_connected(tree):
+    """
+    Check whether the socket under a tree connect is still open.
+    """
+    transport = getattr(tree.session.connection, "transport", None)
+    return transport is None or transport.connected
 
-# Lock for thread-safe index management
-index_lock = Lock()
+def get_worker_tree(reconnect=False):
+    """
+    Return the tree connect of the calling worker, opening it on first use.
+    A broken connection (or any connection when reconnect is True) is replaced with a new one.
+    """
+    tree = getattr(worker_connection, "tree", None)
+    if tree is not None and (reconnect or not is_smb_tree_connected(tree)):
+        disconnect_smb_tree(tree)
+        with worker_trees_lock:
+            worker_trees.remove(tree)
+        tree = None
+
+    if tree is None:
+        tree = connect_smb_tree()
+        worker_connection.tree = tree
+        with worker_trees_lock:
+            worker_trees.append(tree)
+    return tree
+
+def run_with_retries(operation, cleanup=None):
+    """
+    Run an SMB operation with the calling worker's tree connect. If it fails for any reason other than a
+    missing file or folder (a dropped connection, an expired session, a failed read), it is tried again up
+    to retry_attempts times, each time after a longer delay and on a new connection and session.
 
-# Shared indices
-roomIndex = 0
-boxIndex = 0
+    Args:
+        operation (function): Called with the tree connect to use.
+        cleanup (function): Called after each failure, e.g. to drop anything written before it.
 
-def get_smb_folder_size(tree, folder_path):
+    Returns:
+        The result of the operation.
     """
-    Calculate the total size of files in a folder on an SMB server.
+    for attempt in range(retry_attempts + 1):
+        try:
+            if attempt == 0:
+                tree = get_worker_tree()
+            else:
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+                PerfStats.count("reconnects")
+                tree = get_worker_tree(reconnect=True)
+            return operation(tree)
+        except Exception as e:
+            if cleanup is not None:
+                cleanup()
+            if AsyncFetch.is_file_missing(e) or attempt == retry_attempts:
+                raise
+            PerfStats.count("retries")
+
+def list_smb_folder(tree, folder_path):
     """
-    total_size = 0
-    try:
-        # Open the folder on the SMB share
-        folder = Open(tree, folder_path)
+    List the contents of a folder on an SMB server.
+    Raises an exception if the folder cannot be opened (e.g. it does not exist).
+
+    Returns:
+        list: One dictionary per entry with the keys "name", "size", "last_write" (ISO timestamp) and "is_dir".
+    """
+    # Open the folder on the SMB share
+    folder = Open(tree, folder_path)
+    with PerfStats.timer("smb_list_folder"):
         folder.create(
             desired_access=FilePipePrinterAccessMask.GENERIC_READ,  # Use GENERIC_READ for directory access
             impersonation_level=0,
@@ -110,137 +295,561 @@ def get_smb_folder_size(tree, folder_path):
             create_options=0
         )
 
-        # List the contents of the folder
-        entries = folder.query_directory(
-            pattern= "*",  # Wildcard pattern to match all files and directories
-            file_information_class=FileInformationClass.FILE_DIRECTORY_INFORMATION
+        # List the contents of the folder, asking again until the server has no more entries
+        entries = []
+        try:
+            while True:
+                try:
+                    batch = folder.query_directory(
+                        pattern= "*",  # Wildcard pattern to match all files and directories
+                        file_information_class=FileInformationClass.FILE_DIRECTORY_INFORMATION
+                    )
+                except NoMoreFiles:
+                    break
+                if not batch:
+                    break
+                entries.extend(batch)
+        finally:
+            folder.close()
+
+    listing = []
+    for entry in entries:
+        # Decode the filename properly
+        filename = entry['file_name'].get_value().decode('utf-16-le').strip()
+        if filename not in [".", ".."]:  # Skip current and parent directory entries
+            listing.append({
+                "name": filename,
+                "size": entry['end_of_file'].get_value(),
+                "last_write": entry['last_write_time'].get_value().isoformat(),
+                "is_dir": bool(entry['file_attributes'].get_value() & FileAttributes.FILE_ATTRIBUTE_DIRECTORY),
+            })
+    return listing
+
+def list_worker_folder(folder_path):
+    """
+    List a folder on the SMB server with the calling worker's connection, retrying if the listing fails.
+    """
+    return run_with_retries(lambda tree: list_smb_folder(tree, folder_path))
+
+def is_listing_current(cached_listing, last_write):
+    """
+    Check whether a cached folder listing can be reused without listing the folder again: the folder's last
+    write time is unchanged (so no files were added, removed or renamed), it has no subfolders, and none of
+    its files were still being written to within a day of the cached listing (a file growing in place
+    changes its own size but not the folder's last write time).
+    """
+    if not cached_listing or cached_listing.get("last_write") != last_write:
+        return False
+    settled_before = datetime.fromisoformat(cached_listing["listed_at"]) - timedelta(days=1)
+    return all(not entry["is_dir"] and datetime.fromisoformat(entry["last_write"]) < settled_before
+               for entry in cached_listing["entries"])
+
+def scan_smb_tree(executor, folder_path, cached_tree):
+    """
+    Walk a folder tree on the SMB server, listing subfolders in parallel on the worker connections.
+    Folders that have not changed since the cached scan are taken from the cache without being opened.
+
+    Args:
+        executor (ThreadPoolExecutor): The worker pool to list the folders on.
+        folder_path (str): Path to the top folder on the SMB share.
+        cached_tree (dict): The tree from the last run (see save_tree_cache), or an empty dictionary.
+
+    Returns:
+        tuple: (remote_tree, failed_folders) where remote_tree maps folder paths to {"last_write", "listed_at",
+        "entries"}, entries being the folder listing (see list_smb_folder), and failed_folders is the set of
+        folders that exist but could not be listed.
+    """
+    remote_tree = {}
+    failed_folders = set()
+    listed_at = datetime.now(timezone.utc).isoformat()
+    futures = {executor.submit(list_worker_folder, folder_path): (folder_path, None)}
+
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            dir_path, last_write = futures.pop(future)
+            try:
+                entries = future.result()
+            except Exception as e:
+                print(f"Error accessing folder {dir_path}: {e}")
+                if not AsyncFetch.is_file_missing(e):
+                    failed_folders.add(dir_path)
+                continue
+            remote_tree[dir_path] = {"last_write": last_write, "listed_at": listed_at, "entries": entries}
+
+            # List the subfolders that changed
+            for entry in entries:
+                if entry["is_dir"]:
+                    sub_path = f"{dir_path}/{entry['name']}"
+                    if is_listing_current(cached_tree.get(sub_path), entry["last_write"]):
+                        remote_tree[sub_path] = cached_tree[sub_path]
+                    else:
+                        futures[executor.submit(list_worker_folder, sub_path)] = (sub_path, entry["last_write"])
+    return remote_tree, failed_folders
+
+def load_tree_cache():
+    """
+    Load the remote tree saved by the last run, or an empty tree if there is none.
+    """
+    try:
+        with open(tree_cache_path, "r", encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_tree_cache(remote_tree):
+    """
+    Save the remote tree for the next run.
+    """
+    FileUtils.write_json_file(tree_cache_path, remote_tree)
+
+def list_tree_files(remote_tree):
+    """
+    Map the path of every file in a remote tree to its (size, last write).
+    """
+    return {f"{dir_path}/{entry['name']}": (entry["size"], entry["last_write"])
+            for dir_path, listing in remote_tree.items() for entry in listing["entries"] if not entry["is_dir"]}
+
+def get_smb_folder_size(remote_tree, folder_path):
+    """
+    Calculate the total size of files in a folder on an SMB server, from the scanned tree.
+    """
+    return sum(size for file_path, (size, _) in list_tree_files(remote_tree).items() if file_path.startswith(folder_path + "/"))
+
+def list_day_files(remote_tree, box_path, box_manifest, start_date, end_date):
+    """
+    Go through the year folders of a box in the scanned tree and find the day files ("!YYYY-MM-DD")
+    that exist in the date range and are new or changed since they were recorded in the box manifest.
+    Missing box or year folders simply have no day files.
+
+    Returns:
+        tuple: (day_files, rebuild) where day_files is a date-sorted list of (date, remote path, size, last write)
+        to fetch, and rebuild is True if the combined file has to be written from the start, because there is
+        no manifest for the box, an already merged file changed or disappeared, or a new file is older than
+        the last merged date.
+    """
+    merged_files = box_manifest.get("files", {})
+    last_date = box_manifest.get("last_date", "")
+    first_date_str = start_date.strftime("%Y-%m-%d")
+    last_date_str = end_date.strftime("%Y-%m-%d")
+
+    # Only look at the year folders that exist
+    box_listing = remote_tree.get(box_path, {"entries": []})
+    years = sorted(int(entry["name"]) for entry in box_listing["entries"]
+                   if entry["is_dir"] and entry["name"].isdigit() and start_date.year <= int(entry["name"]) <= end_date.year)
+
+    listed_files = []
+    for year in years:
+        year_path = f"{box_path}/{year}"
+        if year_path not in remote_tree:
+            continue  # The folder could not be listed
+        for entry in remote_tree[year_path]["entries"]:
+            match = re.fullmatch(r"!(\d{4}-\d{2}-\d{2})", entry["name"])
+            if entry["is_dir"] or not match:
+                continue
+            date_str = match.group(1)
+            if first_date_str <= date_str <= last_date_str:
+                listed_files.append((date_str, f"{year_path}/{entry['name']}", entry["size"], entry["last_write"]))
+    listed_files.sort()
+
+    new_files = [day_file for day_file in listed_files if merged_files.get(day_file[1]) != [day_file[2], day_file[3]]]
+    listed_paths = {path for _, path, _, _ in listed_files}
+    rebuild = (not box_manifest
+               or any(path in merged_files or date_str <= last_date for date_str, path, _, _ in new_files)
+               or any(path not in listed_paths for path in merged_files))
+    if rebuild:
+        return listed_files, True
+    return new_files, False
+
+def fetch_smb_file(tree, file_path, combined_file):
+    """
+    Read a file from the SMB share and append its content to the combined file.
+    Several reads are kept outstanding at once and each chunk is written out as soon as it arrives,
+    so only a few chunks are ever held in memory.
+
+    Returns:
+        tuple: (bytes written, remote size, remote last write time as an ISO timestamp).
+    """
+    # Open the file on the SMB share
+    file = Open(tree, file_path)
+    with PerfStats.timer("smb_create"):
+        file.create(
+            desired_access=FilePipePrinterAccessMask.GENERIC_READ,
+            impersonation_level=0,
+            file_attributes=0,
+            share_access=1,
+            create_disposition=1,
+            create_options=0
         )
 
-        for entry in entries:
-            # Decode the filename properly
-            filename = entry['file_name'].get_value().decode('utf-16-le').strip()
-            if filename not in [".", ".."]:  # Skip current and parent directory entries
-                full_path = f"{folder_path}/{filename}"
-                if entry['file_attributes'].get_value() & FileAttributes.FILE_ATTRIBUTE_DIRECTORY:
-                    # Recursively calculate size for subdirectories
-                    total_size += get_smb_folder_size(tree, full_path)
-                else:
-                    # Add the size of the file
-                    file_size = entry['end_of_file'].get_value()
-                    total_size += file_size
-
-        folder.close()
-    except Exception as e:
-        print(f"Error accessing folder {folder_path}: {e}")
-    return total_size
+    connection = tree.session.connection
+    read_size = min(chunk_size, connection.max_read_size)
+    file_size = file.end_of_file
+    written = 0
+    offset = 0
+    pending = deque()  # Outstanding reads in file order
 
-folder_path = "WLynch_Labs/Data Backup"  # Path to the folder on the SMB server
-folder_size_bytes = get_smb_folder_size(tree, folder_path)  # Pass the tree object and folder path
-folder_size_mb = folder_size_bytes / (1024 * 1024)  # Convert bytes to MB
+    try:
+        while True:
+            # Queue up reads until read_depth are outstanding or the whole file has been requested
+            while offset < file_size and len(pending) < read_depth:
+                length = min(read_size, file_size - offset)
+                read_request, receive_read = file.read(offset, length, send=False)
+                try:
+                    request = connection.send(read_request, sid=tree.session.session_id, tid=tree.tree_connect_id,
+                                              credit_request=read_depth * ((length - 1) // 65536 + 1))
+                except SMBException:
+                    if pending:
+                        break  # Out of credits, wait for an outstanding read first
+                    if read_size <= 65536:
+                        raise
+                    read_size //= 2  # Not enough credits for a read this size
+                    continue
+                pending.append((request, receive_read, length, time.perf_counter()))
+                offset += length
+
+            if not pending:
+                break  # End of file reached
+
+            # Write each chunk straight to the combined file
+            request, receive_read, length, sent_at = pending.popleft()
+            try:
+                chunk = receive_read(request)
+                PerfStats.record("smb_read", time.perf_counter() - sent_at)
+            except Exception:
+                PerfStats.count("failed_reads")
+                raise  # The caller drops what was written and tries the file again
+            combined_file.write(chunk)
+            written += len(chunk)
+            if len(chunk) < length:
+                break  # The file is shorter than when it was opened
+    finally:
+        # Collect any reads still outstanding before closing the file
+        for request, receive_read, _, _ in pending:
+            try:
+                receive_read(request)
+            except Exception:
+                pass
+        try:
+            with PerfStats.timer("smb_close"):
+                file.close()
+        except Exception:
+            if is_smb_tree_connected(tree):
+                raise
+
+    return written, file_size, file.last_write_time.isoformat()
+
+def write_merge_manifest(results_dir):
+    """
+    Save the merge manifest to the results folder.
+    """
+    with manifest_lock:
+        FileUtils.write_json_file(os.path.join(results_dir, manifest_file_name), merge_manifest, indent=1)
 
-# Input for the target folder size in MB
-target_size_mb = folder_size_mb
-target_size_bytes = target_size_mb * 1024 * 1024  # Convert MB to bytes
+folder_path = "WLynch_Labs/Data Backup"  # Path to the folder on the SMB server
 
 # Initialize a variable to track the cumulative size of processed files
 cumulative_size = 0
 
-# Create a progress bar based on the target size
-progress_bar = tqdm(total=target_size_bytes, desc="Processing Files", unit="B", unit_scale=True, position=0, leave=True)
-
 # Lock for thread-safe progress bar updates
 progress_lock = Lock()
 
-def process_box(start_date, end_date, results_dir, tree):
+def get_combined_file_path(results_dir, box_name, compressed=None):
     """
-    Function to process a single box for a given room.
-    Dynamically updates roomIndex and boxIndex.
+    Return the path of the combined file of a box, compressed or not (by default as set in compress_output).
     """
-    global roomIndex, boxIndex, cumulative_size
+    if compressed is None:
+        compressed = compress_output
+    combined_file_path = os.path.join(results_dir, f"{box_name}.txt")
+    return combined_file_path + CompressedBox.compressed_suffix if compressed else combined_file_path
 
-    while True:
-        # Safely get the current indices and update them
-        with index_lock:
-            if roomIndex >= len(room):
-                return  # Exit if all rooms are processed
-
-            # Get the current room and box indices
-            current_room = roomIndex
-            current_box = boxIndex
+def get_part_file_path(results_dir, box_name, year):
+    """
+    Return the path of the (hidden) part file holding one year of a box until it is added to the combined file.
+    """
+    return os.path.join(results_dir, f".{box_name}.{year}.part")
 
-            # Increment boxIndex and manage roomIndex
-            boxIndex += 1
-            if boxIndex % 2 == 0:  # After every two boxes, move to the next room
-                roomIndex += 1
+def get_part_checkpoint_path(part_file_path):
+    """
+    Return the path of the checkpoint saved next to a part file once all of its day files are fetched.
+    """
+    return part_file_path + ".json"
 
-        # Reset the current date to the start date for each box
-        current_date = start_date.date()
+def load_part_checkpoint(part_file_path):
+    """
+    Load the checkpoint of a finished part file, or None if the part file was not finished.
+    """
+    try:
+        with open(get_part_checkpoint_path(part_file_path), "r", encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if os.path.getsize(part_file_path) == checkpoint["size"]:
+            return checkpoint
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_part_checkpoint(part_file_path, checkpoint):
+    """
+    Save the checkpoint of a finished part file.
+    """
+    FileUtils.write_json_file(get_part_checkpoint_path(part_file_path), checkpoint)
 
-        # Define the output file path for the combined data
-        combined_file_path = os.path.join(results_dir, f"{room[current_room]}_{box[current_box]}.txt")
+def plan_box(remote_tree, room_name, box_range, start_date, end_date):
+    """
+    Find the day files of a box to fetch in the scanned tree and split them into one task per year.
+    A combined file holding more than its manifest records (years added by a run that was interrupted
+    before it saved the manifest) is cut back to the recorded size first. A box that has to be written
+    again is dropped from the manifest right away.
+
+    Returns:
+        dict: The box plan with the keys "name", "room", "box_range", "rebuild", "manifest" (the box manifest
+        that is kept) and "years" (year mapped to the date-sorted day files to fetch that year).
+    """
+    box_name = f"{room_name}_{box_range}"
+    combined_file_path = get_combined_file_path(results_dir, box_name)
+
+    with manifest_lock:
+        box_manifest = merge_manifest.get(box_name, {})
+    if not incremental_merge or not os.path.exists(combined_file_path):
+        box_manifest = {}  # Start the combined file from scratch
+    elif "size" in box_manifest and os.path.getsize(combined_file_path) != box_manifest["size"]:
+        if os.path.getsize(combined_file_path) < box_manifest["size"]:
+            box_manifest = {}  # The file lost data, write it again
+        else:
+            with open(combined_file_path, "r+b") as combined_file:
+                combined_file.truncate(box_manifest["size"])
+    if write_session_dataset and not box_manifest.get("dataset_complete"):
+        box_manifest = {}  # Not every year of the box is in the session dataset yet
+
+    # Fetch only the day files that exist (the new or changed ones in an incremental run)
+    day_files, rebuild = list_day_files(remote_tree, f"{folder_path}/{room_name}/{box_range}", box_manifest, start_date, end_date)
+    if rebuild:
+        box_manifest = {}  # Write the combined file again in date order
+
+        # Forget the box before anything is removed, so a run interrupted (or a year that fails) while the box
+        # is written again leaves neither the combined file nor the dataset only partly written
+        with manifest_lock:
+            forgotten = merge_manifest.pop(box_name, None) is not None
+        if forgotten:
+            write_merge_manifest(results_dir)
+        if write_session_dataset:
+            SessionDataset.remove_box(dataset_dir, room_name, box_range)
+
+    years = {}
+    for day_file in day_files:
+        years.setdefault(day_file[0][:4], []).append(day_file)
+    return {"name": box_name, "room": room_name, "box_range": box_range, "rebuild": rebuild, "manifest": box_manifest, "years": years}
+
+def process_box_year(box_plan, year, day_files, results_dir):
+    """
+    Function to fetch the day files of one box and year, in date order, into a part file,
+    and add the sessions fetched to the session dataset. Each worker uses its own SMB connection.
+    A part file finished by an interrupted run for the same day files is reused instead of fetched again.
 
-        # Open the combined file in write-binary mode
-        with open(combined_file_path, "wb") as combined_file:
-            while current_date <= end_date:
-                date_str = current_date.strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
+    Returns:
+        tuple: (files, last date) where files maps the remote path of every file fetched to [size, last write].
+    """
+    part_file_path = get_part_file_path(results_dir, box_plan["name"], year)
+    checkpoint = load_part_checkpoint(part_file_path)
+    if checkpoint is not None and checkpoint["day_files"] == [list(day_file) for day_file in day_files]:
+        merged_files, last_date = checkpoint["files"], checkpoint["last_date"]
+        with progress_lock:
+            progress_bar.update(sum(size for _, _, size, _ in day_files))
+        PerfStats.count("years_resumed")
+    else:
+        merged_files, last_date = fetch_box_year(box_plan, day_files, part_file_path)
+        save_part_checkpoint(part_file_path, {"day_files": day_files, "files": merged_files, "last_date": last_date,
+                                              "size": os.path.getsize(part_file_path)})
+
+    # Parse the sessions fetched into the dataset, one Parquet file per task. If that fails the box is left
+    # unfinished, as for a file that cannot be fetched, so the year is not missing from the dataset for good
+    if write_session_dataset and merged_files:
+        try:
+            with PerfStats.timer("dataset_write"):
+                SessionDataset.write_sessions(dataset_dir, box_plan["room"], box_plan["box_range"], year,
+                                              part_file_path, f"part-{day_files[0][0]}")
+        except Exception as e:
+            raise RuntimeError(f"The sessions could not be written to the dataset: {e}") from e
 
-                # Dynamically construct the file path based on the year
-                year = current_date.year  # Extract the year from the current date
-                file_path = f"WLynch_Labs/Data Backup/{room[current_room]}/{box[current_box]}/{year}/!{date_str}"
+    return merged_files, last_date
 
-                try:
-                    # Open the file on the SMB share
-                    file = Open(tree, file_path)
-                    file.create(
-                        desired_access=FilePipePrinterAccessMask.GENERIC_READ,
-                        impersonation_level=0,
-                        file_attributes=0,
-                        share_access=1,
-                        create_disposition=1,
-                        create_options=0
-                    )
+def fetch_box_year(box_plan, day_files, part_file_path):
+    """
+    Fetch day files, in date order, into a part file. Files that no longer exist are skipped; any other
+    failure is retried (see run_with_retries) and, if the file still cannot be fetched, raised.
 
-                    # Read file content in chunks
-                    data = b""
-                    offset = 0
-                    while True:
-                        try:
-                            chunk = file.read(offset, chunk_size)
-                            if not chunk:
-                                break  # End of file reached
-                            data += chunk
-                            offset += len(chunk)
-                        except Exception:
-                            break  # Exit the loop if an error occurs during reading
-
-                    file.close()
-
-                    # Check if the file is empty
-                    if not data:
-                        current_date += timedelta(days=1)
-                        continue
-
-                    # Append the content to the combined file
-                    combined_file.write(data)
-
-                    # Update the cumulative size and progress bar
-                    with progress_lock:
-                        cumulative_size += len(data)
-                        progress_bar.update(len(data))
-
-                except Exception:
-                    current_date += timedelta(days=1)
-                    continue  # Ignore errors and continue
-
-                # Move to the next date
-                current_date += timedelta(days=1)
+    Returns:
+        tuple: (files, last date) where files maps the remote path of every file fetched to [size, last write].
+    """
+    started_at = time.perf_counter()
+    merged_files = {}
+    last_date = ""
+
+    def record_file(day_file, written):
+        """
+        Record a fetched file in the manifest so the next run can skip it, and update the progress bar.
+        """
+        global cumulative_size
+        nonlocal last_date
+        date_str, file_path, size, last_write = day_file
+        merged_files[file_path] = [size, last_write]
+        last_date = max(last_date, date_str)
+
+        # Update the cumulative size and progress bar
+        with progress_lock:
+            cumulative_size += written
+            progress_bar.update(written)
+        PerfStats.count("files_fetched")
+
+    def record_missing(day_file, error):
+        """
+        Count a file that no longer exists against its box.
+        """
+        PerfStats.count(f"failed_opens.{box_plan['name']}")
+
+    with open(part_file_path, "wb") as combined_file:
+        # Fetch many files at once; whatever is left if a file fails is fetched one file at a time below
+        handled = 0
+        if async_fetch_concurrency > 0:
+            tree = run_with_retries(lambda tree: tree)  # Connect first, retrying if the server does not answer
+            handled = AsyncFetch.fetch_files_in_order(tree, day_files, combined_file, async_fetch_concurrency,
+                                                      record_file, record_missing)
+
+        for day_file in day_files[handled:]:
+            position = combined_file.tell()
+
+            def drop_written():
+                """
+                Drop anything written for this file before it failed.
+                """
+                combined_file.seek(position)
+                combined_file.truncate()
+
+            try:
+                written, _, _ = run_with_retries(lambda tree: fetch_smb_file(tree, day_file[1], combined_file), drop_written)
+            except Exception as e:
+                if not AsyncFetch.is_file_missing(e):
+                    raise  # Leave the box unfinished rather than merge it with a gap
+                record_missing(day_file, e)
+                continue  # Skip files removed since the listing
+
+            record_file(day_file, written)
+
+        # Bytes fetched per second, by worker and by box
+        fetched_bytes = combined_file.tell()
+        fetch_seconds = time.perf_counter() - started_at
+        PerfStats.add_throughput(f"worker_bytes.{current_thread().name}", fetched_bytes, fetch_seconds)
+        PerfStats.add_throughput(f"box_bytes.{box_plan['name']}", fetched_bytes, fetch_seconds)
+
+    return merged_files, last_date
+
+def assemble_box(box_plan, year_results, results_dir):
+    """
+    Add the year part files of a box to its combined file in year order (starting the file over when
+    the box is rebuilt) and record the fetched files, the last date, the size of the combined file and
+    whether every year is in the session dataset in the merge manifest, which is saved right away as the
+    checkpoint of the box.
+    """
+    box_name = box_plan["name"]
+    merged_files = dict(box_plan["manifest"].get("files", {}))
+    last_date = box_plan["manifest"].get("last_date", "")
+
+    combined_file_path = get_combined_file_path(results_dir, box_name)
+    if box_plan["rebuild"]:
+        # Start the combined file over, in either format so none is left over from an earlier run in the other one
+        # (plan_box already dropped the box from the manifest)
+        CompressedBox.remove(get_combined_file_path(results_dir, box_name, True))
+        plain_file_path = get_combined_file_path(results_dir, box_name, False)
+        if os.path.exists(plain_file_path):
+            os.remove(plain_file_path)
+        open(combined_file_path, "wb").close()
+
+    for year in sorted(box_plan["years"]):
+        part_file_path = get_part_file_path(results_dir, box_name, year)
+        if compress_output:
+            CompressedBox.append_file(combined_file_path, part_file_path)
+        else:
+            with open(part_file_path, "rb") as part_file, open(combined_file_path, "ab") as combined_file:
+                shutil.copyfileobj(part_file, combined_file, chunk_size)
+
+        year_files, year_last_date = year_results[year]
+        merged_files.update(year_files)
+        last_date = max(last_date, year_last_date)
+
+    with manifest_lock:
+        merge_manifest[box_name] = {"files": merged_files, "last_date": last_date, "size": os.path.getsize(combined_file_path),
+                                    "dataset_complete": write_session_dataset}
+    write_merge_manifest(results_dir)
+
+    # The part files are only removed once the manifest records them as merged
+    for year in box_plan["years"]:
+        part_file_path = get_part_file_path(results_dir, box_name, year)
+        os.remove(part_file_path)
+        os.remove(get_part_checkpoint_path(part_file_path))
+
+# Save the manifest right away, so a run that is interrupted can be continued by the next one (as an incremental run)
+write_merge_manifest(results_dir)
 
 with ThreadPoolExecutor(max_workers=num_threads) as executor:  # Adjust max_workers based on num_threads
-    futures = [executor.submit(process_box, start_date, end_date, results_dir, tree) for _ in range(num_threads)]
-
-    # Wait for all threads to complete
+    # Scan the remote tree in parallel, reusing the listings of folders that have not changed since the last run
+    cached_tree = load_tree_cache()
+    remote_tree, failed_folders = scan_smb_tree(executor, folder_path, cached_tree)
+    try:
+        save_tree_cache(remote_tree)
+    except Exception as e:
+        print(f"Error saving the remote tree cache: {e}")
+
+    # Report what changed on the server since the last run
+    cached_files = list_tree_files(cached_tree)
+    remote_files = list_tree_files(remote_tree)
+    changed_files = sum(1 for file_path, file_info in remote_files.items() if cached_files.get(file_path) != file_info)
+    removed_files = len(set(cached_files) - set(remote_files))
+    folder_size_mb = get_smb_folder_size(remote_tree, folder_path) / (1024 * 1024)  # Convert bytes to MB
+    print(f"Remote folder: {len(remote_files)} files, {folder_size_mb:.1f} MB "
+          f"({changed_files} new or changed, {removed_files} removed since the last scan).")
+
+    # Find the day files to fetch for every box
+    box_list = [(room_name, box_range) for room_name, box_ranges in rooms.items() for box_range in box_ranges]
+    box_plans = []
+    unfinished_boxes = []
+    for room_name, box_range in box_list:
+        # A box whose folders could not all be listed is left as it is (merging it would leave out the unlisted files)
+        box_path = f"{folder_path}/{room_name}/{box_range}"
+        if any(box_path == failed or box_path.startswith(failed + "/") or failed.startswith(box_path + "/") for failed in failed_folders):
+            unfinished_boxes.append(f"{room_name}_{box_range}")
+            continue
+        box_plans.append(plan_box(remote_tree, room_name, box_range, start_date, end_date))
+
+    # Create a progress bar based on the size of the files to fetch
+    target_size_bytes = sum(size for box_plan in box_plans for day_files in box_plan["years"].values() for _, _, size, _ in day_files)
+    progress_bar = tqdm(total=target_size_bytes, desc="Processing Files", unit="B", unit_scale=True, position=0, leave=True)
+
+    # Queue one task per (room, box, year), biggest first so no long task is left running at the end
+    tasks = [(box_plan, year, day_files) for box_plan in box_plans for year, day_files in box_plan["years"].items()]
+    tasks.sort(key=lambda task: sum(size for _, _, size, _ in task[2]), reverse=True)
+    futures = {executor.submit(PerfStats.queued("task_queue_wait", PerfStats.profiled(process_box_year)),
+                               box_plan, year, day_files, results_dir): (box_plan, year)
+               for box_plan, year, day_files in tasks}
+
+    # Boxes with nothing to fetch are finished right away
+    remaining_years = {box_plan["name"]: len(box_plan["years"]) for box_plan in box_plans}
+    year_results = {box_plan["name"]: {} for box_plan in box_plans}
+    for box_plan in box_plans:
+        if not box_plan["years"]:
+            assemble_box(box_plan, {}, results_dir)
+
+    # Put each box together in year order once all of its years are fetched
     for future in as_completed(futures):
-        future.result()
+        box_plan, year = futures[future]
+        try:
+            year_results[box_plan["name"]][year] = future.result()
+        except Exception as e:
+            print(f"Error merging {box_plan['name']} {year}: {e}")
+            if box_plan["name"] not in unfinished_boxes:
+                unfinished_boxes.append(box_plan["name"])
+        remaining_years[box_plan["name"]] -= 1
+        if remaining_years[box_plan["name"]] == 0 and box_plan["name"] not in unfinished_boxes:
+            assemble_box(box_plan, year_results[box_plan["name"]], results_dir)
 
 # Articially complete progress bar to 100%
 progress_bar.n = progress_bar.total
@@ -250,12 +859,46 @@ progress_bar.refresh()  # Refresh the progress bar to show completion
 # Close the progress bar
 progress_bar.close()
 
+# Boxes left unfinished keep their last merged state; the years fetched so far are kept for the next run
+if unfinished_boxes:
+    print(f"Not finished because of errors: {', '.join(unfinished_boxes)}. "
+          f"Run the script again and answer yes to fetch only new files to continue where this run stopped.")
+
+# Remove part files no unfinished box is waiting for (e.g. left by a run interrupted while removing them)
+for file_name in os.listdir(results_dir):
+    if file_name.endswith((".part", ".part.json")) and not any(file_name.startswith(f".{box_name}.") for box_name in unfinished_boxes):
+        os.remove(os.path.join(results_dir, file_name))
+
+# Build the animal ID index for the merged files so IDFinder can seek straight to each block
+try:
+    with PerfStats.timer("index_update"):
+        IDIndex.update_index(results_dir)
+    print("ID index updated.")
+except Exception as e:
+    print(f"Error building the ID index: {e}")
+
+# Mark the folder as finished, for the query server to pick up
+with open(merge_complete_path, "w", encoding="utf-8") as merge_complete_file:
+    merge_complete_file.write(datetime.now().isoformat(timespec="seconds"))
+
+# Save the timings of the run so slow boxes and regressions can be spotted
+if write_performance_report:
+    try:
+        report_path = PerfStats.write_report(os.path.join(script_dir, "Reports"), "DataMerger")
+        print(f"Performance report saved to '{report_path}'.")
+    except Exception as e:
+        print(f"Error writing the performance report: {e}")
+
 # Final message
 print("Processing complete.")
 
 # Play an alert sound
 os.system('afplay /System/Library/Sounds/Glass.aiff')  # Replace with your desired sound file
 
+# Close the worker connections
+for worker_tree in worker_trees:
+    disconnect_smb_tree(worker_tree)
+
 # Close the SMB session in the correct order
 try:
     if tree:
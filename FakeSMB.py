@@ -0,0 +1,306 @@
+import os
+import sys
+import runpy  # Import for running a script against the stand-in share
+import heapq  # Import for the queue of responses waiting out the simulated latency
+import fnmatch  # Import for matching the directory query pattern
+import time
+from datetime import datetime, timezone
+from threading import Condition, Event, Lock, Thread
+from smbprotocol.exceptions import SMBException, SMBConnectionClosed, NoMoreFiles, EndOfFile, ObjectNameNotFound, ObjectPathNotFound
+import smbprotocol.connection
+import smbprotocol.session
+import smbprotocol.tree
+import smbprotocol.open
+
+# An in-process stand-in for the SMB share: a local folder served through the parts of the smbprotocol
+# Connection/Session/TreeConnect/Open API the scripts use (including out-of-band sends, compound requests and
+# credits), so the merger can be run and tested without the real server. Call install() before the scripts
+# import smbprotocol, or run a script against a folder with: python FakeSMB.py <share folder> [script]
+
+# Local folder standing in for the root of the share
+share_root = os.environ.get("LYNCHLAB_FAKE_SMB", "")
+
+# Simulated network round trip per request (or per compound request) in seconds
+latency = float(os.environ.get("LYNCHLAB_FAKE_SMB_LATENCY", "0"))
+
+# Largest read the server accepts, and the credits it grants when a session starts and at most in total
+max_read_size = 8 * 1024 * 1024
+initial_credits = 64
+max_credits = 8192
+
+# Responses waiting out the latency, as (due time, order, requests) entries
+pending_responses = []
+pending_condition = Condition()
+pending_order = 0
+responder = None
+
+class Field:
+    """
+    A field of a directory entry, read with get_value() like the smbprotocol structures.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get_value(self):
+        return self.value
+
+class Transport:
+    """
+    The socket of a connection, only tracking whether it is open.
+    """
+    def __init__(self):
+        self.connected = False
+
+class Message:
+    """
+    A request built out of band (send=False): the operation to run on the share and its credit charge.
+    """
+    def __init__(self, operation, credit_charge=1):
+        self.operation = operation
+        self.credit_charge = credit_charge
+
+class Request:
+    """
+    A sent request. response_event is set once the response has arrived.
+    """
+    def __init__(self, connection, message, credit_request):
+        self.connection = connection
+        self.message = message
+        self.credit_request = credit_request
+        self.response_event = Event()
+        self.result = None
+        self.error = None
+
+    def complete(self):
+        """
+        Deliver the response, which gives back the credits the request used plus any extra it asked for.
+        """
+        window = self.connection.sequence_window
+        with self.connection.sequence_lock:
+            granted = max(self.message.credit_charge, self.credit_request or 0)
+            window["high"] = min(window["high"] + granted, window["low"] + max_credits)
+        self.response_event.set()
+
+def respond(requests):
+    """
+    Let the responses to the requests arrive, after the simulated latency.
+    """
+    global pending_order, responder
+    if latency <= 0:
+        for request in requests:
+            request.complete()
+        return
+
+    with pending_condition:
+        if responder is None:
+            responder = Thread(target=run_responder, daemon=True)
+            responder.start()
+        pending_order += 1
+        heapq.heappush(pending_responses, (time.monotonic() + latency, pending_order, requests))
+        pending_condition.notify()
+
+def run_responder():
+    """
+    Set the response events of the requests as they fall due.
+    """
+    with pending_condition:
+        while True:
+            if not pending_responses:
+                pending_condition.wait()
+                continue
+            due, _, requests = pending_responses[0]
+            wait_time = due - time.monotonic()
+            if wait_time > 0:
+                pending_condition.wait(wait_time)
+                continue
+            heapq.heappop(pending_responses)
+            for request in requests:
+                request.complete()
+
+def receive(request):
+    """
+    Wait for the response to a request and return its result, or raise its error.
+    """
+    request.response_event.wait()
+    if request.error is not None:
+        raise request.error
+    return request.result
+
+class Connection:
+    def __init__(self, guid, server_name, port=445, require_signing=True, transport_type=None):
+        self.guid = guid
+        self.server_name = server_name
+        self.port = port
+        self.max_read_size = max_read_size
+        self.transport = Transport()
+        self.sequence_window = {"low": 0, "high": initial_credits}
+        self.sequence_lock = Lock()
+
+    def connect(self, dialect=None, timeout=60, preferred_encryption_algos=None, preferred_signing_algos=None):
+        self.transport.connected = True
+
+    def disconnect(self, close=True):
+        self.transport.connected = False
+
+    def send(self, message, sid=None, tid=None, credit_request=None, message_id=None, async_id=None, force_signature=False):
+        return self.send_messages([message], credit_request)[0]
+
+    def send_compound(self, messages, sid, tid, related=False):
+        return self.send_messages(messages, None, related)
+
+    def send_messages(self, messages, credit_request=None, related=False):
+        """
+        Run the operations of the messages on the share and queue their responses.
+        With related messages, an error in one fails the ones after it as well.
+        """
+        if not self.transport.connected:
+            raise SMBConnectionClosed("The connection is closed")
+
+        with self.sequence_lock:
+            for message in messages:
+                credits_available = self.sequence_window["high"] - self.sequence_window["low"]
+                if message.credit_charge > credits_available:
+                    raise SMBException(f"Request requires {message.credit_charge} credits but only {credits_available} "
+                                       "credits are available")
+                self.sequence_window["low"] += message.credit_charge
+
+        requests = []
+        error = None
+        for message in messages:
+            request = Request(self, message, credit_request)
+            if related and error is not None:
+                request.error = error
+            else:
+                try:
+                    request.result = message.operation()
+                except Exception as e:
+                    request.error = error = e
+            requests.append(request)
+
+        respond(requests)
+        return requests
+
+    def echo(self, sid=0, timeout=60, credit_request=1):
+        receive(self.send(Message(lambda: None), credit_request=credit_request))
+        return credit_request
+
+class Session:
+    def __init__(self, connection, username=None, password=None, require_encryption=True, auth_protocol="negotiate"):
+        self.connection = connection
+        self.username = username
+        self.session_id = 1
+
+    def connect(self):
+        if not self.connection.transport.connected:
+            raise SMBConnectionClosed("The connection is closed")
+
+    def disconnect(self, close=True):
+        pass
+
+class TreeConnect:
+    def __init__(self, session, share_name):
+        self.session = session
+        self.share_name = share_name
+        self.tree_connect_id = 1
+
+    def connect(self, require_secure_negotiate=True):
+        if not os.path.isdir(share_root):
+            raise SMBException(f"The share folder '{share_root}' does not exist")
+
+    def disconnect(self):
+        pass
+
+class Open:
+    def __init__(self, tree, name):
+        self.tree_connect = tree
+        self.connection = tree.session.connection
+        self.file_name = name
+        self.path = os.path.join(share_root, *name.replace("\\", "/").split("/"))
+        self.listed = False
+
+    def call(self, operation, credit_charge, send):
+        message = Message(operation, credit_charge)
+        if not send:
+            return message, receive
+        return receive(self.connection.send(message))
+
+    def create(self, impersonation_level, desired_access, file_attributes, share_access, create_disposition,
+               create_options, create_contexts=None, oplock_level=None, send=True):
+        def create_file():
+            if not os.path.exists(self.path):
+                raise ObjectNameNotFound() if os.path.isdir(os.path.dirname(self.path)) else ObjectPathNotFound()
+            stat = os.stat(self.path)
+            self.end_of_file = stat.st_size if os.path.isfile(self.path) else 0
+            self.last_write_time = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            self.file_attributes = 0x10 if os.path.isdir(self.path) else 0x20
+        return self.call(create_file, 1, send)
+
+    def read(self, offset, length, min_length=0, unbuffered=False, wait=True, send=True):
+        if length > self.connection.max_read_size:
+            raise SMBException(f"The requested read length {length} is greater than the maximum negotiated read size "
+                               f"{self.connection.max_read_size}")
+
+        def read_file():
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+            if not data and length:
+                raise EndOfFile()
+            return data
+        return self.call(read_file, (max(length, 1) - 1) // 65536 + 1, send)
+
+    def close(self, get_attributes=False, send=True):
+        return self.call(lambda: None, 1, send)
+
+    def query_directory(self, pattern, file_information_class, flags=None, file_index=0, max_output=65536, send=True):
+        def list_folder():
+            # Everything is returned by the first query, the next one reports that there are no more files
+            if self.listed:
+                raise NoMoreFiles()
+            self.listed = True
+            entries = []
+            for name in [".", ".."] + sorted(os.listdir(self.path)):
+                if not fnmatch.fnmatch(name, pattern):
+                    continue
+                entry_path = os.path.join(self.path, name)
+                stat = os.stat(entry_path)
+                is_dir = os.path.isdir(entry_path)
+                entries.append({
+                    "file_name": Field(name.encode("utf-16-le")),
+                    "end_of_file": Field(0 if is_dir else stat.st_size),
+                    "last_write_time": Field(datetime.fromtimestamp(stat.st_mtime, timezone.utc)),
+                    "file_attributes": Field(0x10 if is_dir else 0x20),
+                })
+            return entries
+        return self.call(list_folder, 1, send)
+
+def install(folder=None, round_trip=None):
+    """
+    Serve a local folder in place of the SMB share: smbprotocol's Connection, Session, TreeConnect and Open are
+    replaced with the stand-ins, so scripts imported afterwards talk to the folder.
+
+    Args:
+        folder (str): The folder standing in for the root of the share (default: $LYNCHLAB_FAKE_SMB).
+        round_trip (float): Simulated latency per request in seconds (default: $LYNCHLAB_FAKE_SMB_LATENCY or 0).
+    """
+    global share_root, latency
+    if folder is not None:
+        share_root = folder
+    if round_trip is not None:
+        latency = round_trip
+    smbprotocol.connection.Connection = Connection
+    smbprotocol.session.Session = Session
+    smbprotocol.tree.TreeConnect = TreeConnect
+    smbprotocol.open.Open = Open
+
+
+if __name__ == "__main__":
+    # Run a script (DataMergerComplete by default) against a local folder: python FakeSMB.py <share folder> [script]
+    if len(sys.argv) < 2 or not os.path.isdir(sys.argv[1]):
+        print("Usage: python FakeSMB.py <share folder> [script]")
+        sys.exit(1)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    script_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(script_dir, "DataMergerComplete.py")
+    install(os.path.abspath(sys.argv[1]))
+    sys.argv = [script_path]
+    runpy.run_path(script_path, run_name="__main__")
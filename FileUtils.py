@@ -0,0 +1,18 @@
+import os
+import json  # Import for the manifests, checkpoints and sidecars
+
+# Small file helpers shared by the merger and the compressed box files
+
+def write_json_file(file_path, data, indent=None):
+    """
+    Save data as JSON, written to a temporary file first and then moved into place, so a run that stops
+    part way never leaves the file half written.
+
+    Args:
+        file_path (str): Path of the JSON file.
+        data: The data to save.
+        indent (int): Indentation of the JSON, or None to write it on one line.
+    """
+    with open(file_path + ".tmp", "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, indent=indent)
+    os.replace(file_path + ".tmp", file_path)
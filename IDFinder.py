@@ -1,229 +1,546 @@
 import os
+import re  # Import for matching every ID in a single pass
+import sqlite3  # Import for handling errors from the ID index
+import mmap  # Import for searching files without reading them into memory
+from datetime import datetime  # Import for checking the dates of the date filter
 from openpyxl import Workbook  # Import openpyxl for Excel file creation
-from datetime import datetime  # Import for date parsing
 from openpyxl.styles import NamedStyle
 from openpyxl.utils import get_column_letter
 from tqdm import tqdm  # Import tqdm for the progress bar
 import shutil  # Import for folder deletion
-from concurrent.futures import ThreadPoolExecutor, as_completed # Import for multithreading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed # Import for multithreading and multiprocessing
+import IDIndex  # Import for the persistent animal ID index
+import PerfStats  # Import for the timing counters and the performance report of the run
+import CompressedBox  # Import for searching compressed merged files
+import ContextRows  # Import for converting the context lines to rows
 
 # Dynamically determine the folder path for "Data"
 script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the script
 folder_path = os.path.join(script_dir, "Data")  # Path to the "Data" folder
 
-# Ask the user for the output folder name
-output_folder_name = str(input("Enter the name of the output folder (will replace duplicates): ") or "Results").strip()
-output_folder_path = os.path.join(script_dir, output_folder_name)
+# Run the per-file work in separate processes so parsing and workbook generation use every core
+# (set use_processes to False to use threads instead)
+use_processes = True
 
-# Path to the unfound IDs file
-unfound_ids_file_path = os.path.join(script_dir, "Unfound_IDs.txt") # Path to the unfound IDs file
+# Number of worker processes (or threads)
+num_workers = os.cpu_count()
 
-# Check if the folder already exists and delete it if necessary
-if os.path.exists(output_folder_path):
-    try:
-        shutil.rmtree(output_folder_path)
-        print(f"Existing folder '{output_folder_path}' deleted.")
-    except PermissionError:
-        print(f"Error: Unable to delete the existing folder '{output_folder_path}'. Please close any open files and try again.")
-        exit(1)
+# Number of indexed IDs handled by one task: the IDs found in a file are split into batches, so the workbooks
+# of a few large box files are still spread over every worker
+ids_per_task = 4
 
-# Create the new output folder
-os.makedirs(output_folder_path, exist_ok=True)
-print(f"Output folder '{output_folder_path}' created.")
+# Write a performance report (scan, parse and workbook save times) to the Reports folder
+write_performance_report = True
 
-# Input file containing the list of animal ID file paths
-id_file_list_path = os.path.join(script_dir, "ID List.txt")  # Path to the file containing ID file paths
+# Merged box files are named "<room>_<box range>.txt" (".txt.zst" when compressed)
+box_file_pattern = re.compile(r"^(?P<room>[^_]+)_(?P<box_range>.+?)\.txt(\.zst)?$")
 
-# Read the IDs from "ID List.txt" and assign them to ID_list
-ID_list = []
-try:
-    with open(id_file_list_path, 'r', encoding='utf-8') as id_file_list:
-        ID_list = [line.strip() for line in id_file_list.readlines()]  # Read and strip each line
-except FileNotFoundError:
-    print(f"Error: The file '{id_file_list_path}' was not found.")
-    exit(1)
-except PermissionError:
-    print(f"Error: Permission denied for the file '{id_file_list_path}'.")
-    exit(1)
+# A box range ("1-16", "1B-16B") or a single box ("3", "3B")
+box_range_pattern = re.compile(r"^(\d+)([A-Za-z]*)(?:-(\d+)\2)?$")
 
-
-valid_file_processed = True  # Flag to track if any valid files were processed
-# Check if any IDs were loaded
-if not ID_list:
-    valid_file_processed = False  # No valid files were processed
-    print("Error: No IDs were found in 'ID List.txt'.")
-    exit(1)
-
-def search_string_in_files_with_context(folder_path, search_string):
+def search_ids_in_files_with_context(folder_path, search_strings):
     """
-    Search for a given string in all files within a folder and copy lines from two lines above the match
+    Search for every ID in a single pass over all files within a folder. Each file is read once and
+    every line is matched against all IDs together, copying lines from two lines above the match
     until one empty line is encountered.
 
     Args:
         folder_path (str): Path to the folder to search in.
-        search_string (str): The string to search for.
+        search_strings (iterable): The strings to search for.
 
     Returns:
-        dict: A dictionary where keys are file paths and values are lists of matched lines with context.
+        dict: A dictionary where keys are search strings and values are dictionaries mapping file paths
+        to lists of matched lines with context.
     """
     results = {}
 
     # Walk through all files in the folder
     for root, _, files in os.walk(folder_path):
         for file in files:
+            if file.startswith("."):
+                continue  # Skip the ID index and other hidden files
             file_path = os.path.join(root, file)
-            try:
-                # Open and read the file line by line
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    for i, line in enumerate(lines):
-                        if search_string in line:
-                            # Start copying from two lines above the match
-                            start_index = max(0, i - 2)
-                            context = []
-
-                            for j in range(start_index, len(lines)):
-                                current_line = lines[j].strip()
-
-                                # Exclude lines that contain "File:" (case-insensitive)
-                                if not current_line.lower().startswith("file:"):
-                                    context.append(current_line)
-
-                                # Check for consecutive empty lines
-                                if current_line == "":  # Stop after an empty line
-                                    break
-
-                            if file_path not in results:
-                                results[file_path] = []
-                            results[file_path].append(context)
-            except (UnicodeDecodeError, PermissionError):
-                # Skip files that cannot be read
-                print(f"Error reading file: {file_path}")
-                pass
+            for search_string, contexts in search_ids_in_file_with_context(file_path, search_strings).items():
+                results.setdefault(search_string, {})[file_path] = contexts
+
+    return results
+
+def search_ids_in_file_with_context(file_path, search_strings, regions=None):
+    """
+    Search one file for every ID in a single pass, copying lines from two lines above each match
+    until one empty line is encountered. The file is memory-mapped and searched as bytes, and only
+    the context blocks found are decoded, so a stray invalid byte does not hide the other matches.
+
+    Args:
+        file_path (str): Path to the file to search.
+        search_strings (iterable): The strings to search for.
+        regions (list): (start, end) ranges of the (uncompressed) text to search, in file order, end None
+            for the end of the file (see get_date_regions), or None to search the whole file.
+
+    Returns:
+        dict: A dictionary where keys are search strings and values are lists of matched lines with context.
+    """
+    search_strings = sorted(set(search_strings), key=len, reverse=True)
+    results = {}
+    if not search_strings or regions == []:
+        return results
+    if regions is None:
+        regions = [(0, None)]
+
+    # One combined pattern finds the candidate lines; the IDs on a candidate line are then checked
+    # individually so that IDs contained in one another (e.g. "12" and "123") are all reported
+    encoded_strings = [(search_string, search_string.encode("utf-8")) for search_string in search_strings]
+    id_pattern = re.compile(b"|".join(re.escape(encoded_string) for _, encoded_string in encoded_strings))
+
+    try:
+        if CompressedBox.is_compressed(file_path):
+            # Only the frames in the regions are decompressed (an ID can match on any line, so every one of them is searched)
+            with PerfStats.timer("scan_file"):
+                for frame, data, lead in CompressedBox.iter_frames(file_path, regions, with_lead=True):
+                    # The last two lines of the frame before are put in front, for the context of a match on the first lines
+                    data = lead + data
+                    for start, end in regions:
+                        # The part of the region in this frame
+                        start = max(start - frame["start"], 0) + len(lead)
+                        end = len(data) if end is None else min(end - frame["start"] + len(lead), len(data))
+                        if start < end:
+                            search_ids_in_data(data, encoded_strings, id_pattern, results, start, end)
+            return results
+
+        if os.path.getsize(file_path) == 0:
+            return results
+        with PerfStats.timer("scan_file"), open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in regions:
+                search_ids_in_data(data, encoded_strings, id_pattern, results, start, end)
+    except (OSError, ValueError):
+        # Skip files that cannot be read
+        print(f"Error reading file: {file_path}")
+        pass
 
     return results
 
-def process_id(search_string):
+def search_ids_in_data(data, encoded_strings, id_pattern, results, position=0, end=None):
+    """
+    Search some merged text (bytes or mmap) for every ID and add the context blocks found to results
+    (see search_ids_in_file_with_context).
+
+    Args:
+        data (bytes or mmap): The text to search.
+        encoded_strings (list): (ID, encoded ID) tuples, longest first.
+        id_pattern (re.Pattern): Pattern matching any of the encoded IDs.
+        results (dict): IDs mapped to lists of matched lines with context, added to in place.
+        position (int): Offset to start searching at (lines before it are only used as context).
+        end (int): Offset to stop searching at, or None for the end of the text.
     """
-    Process a single ID: search for the ID in files, extract context, and save to an Excel file.
+    if end is None:
+        end = len(data)
+    while True:
+        match = id_pattern.search(data, position, end)
+        if not match:
+            break
+
+        # Find the whole matching line
+        line_start = data.rfind(b"\n", 0, match.start()) + 1
+        line_end = data.find(b"\n", match.end())
+        if line_end == -1:
+            line_end = len(data)
+        line = data[line_start:line_end]
+        matched_ids = [search_string for search_string, encoded_string in encoded_strings if encoded_string in line]
+
+        # Copy from two lines above the match until one empty line is encountered
+        start, block_end = IDIndex.find_block(data, line_start)
+        context = IDIndex.block_context(data[start:block_end])
+
+        # Hand the context block to every ID found on the line
+        for search_string in matched_ids:
+            results.setdefault(search_string, []).append(context)
+
+        position = line_end + 1  # Continue on the next line
+
+def is_file_selected(file_path, rooms=None, box_ranges=None):
     """
-    result = search_string_in_files_with_context(folder_path, search_string.strip("'"))
-    if result:
-        for file, contexts in result.items():
-            # Create a new workbook for each file
-            file_name = f"{search_string}_{os.path.splitext(os.path.basename(file))[0]}.xlsx"
-            output_file_path = os.path.join(output_folder_path, file_name)
+    Check whether a merged box file is for one of the rooms and box ranges asked for, by its name
+    ("<room>_<box range>.txt"). Rooms and box ranges are compared without regard to case; a single box
+    (e.g. "3") selects the box range holding it (e.g. "1-16"). Files named otherwise are only selected
+    when no room or box range is asked for.
 
+    Args:
+        file_path (str): Path to the merged file.
+        rooms (list): Rooms to search (e.g. "G138"), or None for every room.
+        box_ranges (list): Box ranges or boxes to search (e.g. "1-16" or "3"), or None for every box.
+
+    Returns:
+        bool: True if the file is to be searched.
+    """
+    if not rooms and not box_ranges:
+        return True
+    match = box_file_pattern.match(os.path.basename(file_path))
+    if not match:
+        return False
+    if rooms and match.group("room").casefold() not in {room.casefold() for room in rooms}:
+        return False
+    return not box_ranges or any(is_box_in_range(box, match.group("box_range")) for box in box_ranges)
+
+def is_box_in_range(box, box_range):
+    """
+    Check whether a box range or single box asked for (e.g. "1-16" or "3B") is, or lies in, the box range
+    of a merged file (e.g. "1B-16B").
+    """
+    if box.casefold() == box_range.casefold():
+        return True
+    box_match = box_range_pattern.match(box)
+    range_match = box_range_pattern.match(box_range)
+    if not box_match or not range_match or box_match.group(2).casefold() != range_match.group(2).casefold():
+        return False
+    first, last = int(range_match.group(1)), int(range_match.group(3) or range_match.group(1))
+    return first <= int(box_match.group(1)) and int(box_match.group(3) or box_match.group(1)) <= last
+
+def get_date_regions(sessions, start_date=None, end_date=None):
+    """
+    Work out which parts of a merged file hold the sessions of a date range, from where the ID index
+    found its sessions. Each session takes the text from the end of the session before it until the end
+    of its own block (so the "File:" line above a session goes with it), and the last one the rest of the
+    file. Sessions without a readable date are left out when there is a date filter.
+
+    Args:
+        sessions (list): (offset, length, session date) tuples in file order (see IDIndex.lookup_sessions).
+        start_date (str): First date to search (YYYY-MM-DD), or None.
+        end_date (str): Last date to search (YYYY-MM-DD), or None.
+
+    Returns:
+        list: (start, end) ranges of the text to search, in file order, end None for the end of the file.
+        The list is empty if no session of the file is in the date range.
+    """
+    regions = []
+    previous_end = 0
+    for index, (offset, length, session_date) in enumerate(sessions):
+        end = offset + length if index < len(sessions) - 1 else None
+        if session_date is not None and (not start_date or session_date >= start_date) and (not end_date or session_date <= end_date):
+            if regions and regions[-1][1] == previous_end:
+                regions[-1] = (regions[-1][0], end)  # Carries on from the session before
+            else:
+                regions.append((previous_end, end))
+        previous_end = end
+    return regions
+
+def parse_date_filter(date_str):
+    """
+    Check a date typed in for the date filter.
+
+    Returns:
+        str: The date as YYYY-MM-DD, or None if it is empty or not a valid date.
+    """
+    try:
+        return datetime.strptime(date_str.strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def read_indexed_contexts(indexed_blocks):
+    """
+    Read the session blocks found through the ID index straight from the files.
+
+    Args:
+        indexed_blocks (dict): File paths mapped to lists of (offset, length) tuples (see IDIndex.lookup_ids).
+
+    Returns:
+        dict: A dictionary where keys are file paths and values are lists of matched lines with context.
+    """
+    results = {}
+    for file_path, blocks in indexed_blocks.items():
+        results[file_path] = read_indexed_contexts_in_file(file_path, [blocks])[0]
+    return results
+
+def read_indexed_contexts_in_file(file_path, block_lists):
+    """
+    Read several lists of indexed session blocks from one file, opening it only once.
+
+    Returns:
+        list: One list of matched lines with context per list of (offset, length) tuples.
+    """
+    with PerfStats.timer("read_indexed_blocks"):
+        if CompressedBox.is_compressed(file_path):
+            # Each frame holding one of the blocks is decompressed once
+            block_lists = [list(blocks) for blocks in block_lists]
+            data = iter(CompressedBox.read_blocks(file_path, [block for blocks in block_lists for block in blocks]))
+            return [[IDIndex.block_context(next(data)) for _ in blocks] for blocks in block_lists]
+        with open(file_path, 'rb') as f:
+            return [[IDIndex.read_block_context(f, offset, length) for offset, length in blocks] for blocks in block_lists]
+
+def write_contexts_workbook(contexts, output_file_path):
+    """
+    Save the context blocks of one ID in one file to an Excel file, one row per line (see ContextRows).
+    The workbook is written in openpyxl's write-only (streaming) mode, and the column widths are worked
+    out from the values as the lines are converted, so no cells are kept in memory or read back.
+    """
+    # Each thread creates its own Workbook object
+    workbook = Workbook(write_only=True)
+    add_contexts_sheet(workbook, "Data", contexts)
+
+    with PerfStats.timer("save_workbook"):
+        # Save the workbook (output_file_path can also be a file object)
+        workbook.save(output_file_path)
+
+def add_contexts_sheet(workbook, title, contexts):
+    """
+    Add a sheet with the context blocks of one ID in one file, one row per line, to a write-only workbook.
+    """
+    with PerfStats.timer("parse_contexts"):
+        rows, column_widths = ContextRows.get_rows(contexts)
+
+    with PerfStats.timer("save_workbook"):
+        sheet = workbook.create_sheet(title)
+
+        # Column widths have to be set before the first row is written
+        for i, max_length in enumerate(column_widths):
+            sheet.column_dimensions[get_column_letter(i + 1)].width = max_length + 2
+
+        # Write the processed rows to the Excel sheet
+        for columns in rows:
+            sheet.append(columns)
+
+def get_output_file_path(output_folder_path, search_string, file):
+    """
+    Return the path of the Excel file for one ID in one merged file.
+    """
+    base_name = os.path.basename(file)
+    if CompressedBox.is_compressed(base_name):
+        base_name = base_name[:-len(CompressedBox.compressed_suffix)]  # Same name as for the plain file
+    file_name = f"{search_string}_{os.path.splitext(base_name)[0]}.xlsx"
+    return os.path.join(output_folder_path, file_name)
+
+def process_file(file_path, search_names, indexed_blocks, scan_terms, output_folder_path, regions=None):
+    """
+    Process one merged file for a batch of IDs: read the blocks found through the ID index, search the
+    text of the file for the IDs that are not indexed, and save an Excel file for each ID found.
+    A file can be split over several tasks, each with its own batch of IDs.
+    This runs in a worker process, so only the (small) list of IDs found and the timings are sent back.
+
+    Args:
+        file_path (str): Path to the merged file.
+        search_names (dict): Search terms mapped to the IDs as written in the ID list (used in the file names).
+        indexed_blocks (dict): Search terms mapped to lists of (offset, length) tuples of their blocks in this file.
+        scan_terms (list): Search terms to look for in the text of the file.
+        output_folder_path (str): Folder the Excel files are saved to.
+        regions (list): (start, end) ranges of the text to search for the scan terms (see get_date_regions),
+            or None to search the whole file.
+
+    Returns:
+        tuple: (IDs found, timings) where IDs found lists the IDs, as written in the ID list, that were found
+        in the file, and timings are the statistics of a worker process (see PerfStats.collect_worker_stats).
+    """
+    contexts_by_term = {}
+    if indexed_blocks:
+        contexts_by_term.update({search_term: contexts for search_term, contexts in
+                                 zip(indexed_blocks, read_indexed_contexts_in_file(file_path, indexed_blocks.values()))})
+    if scan_terms:
+        for search_term, contexts in search_ids_in_file_with_context(file_path, scan_terms, regions).items():
+            contexts_by_term.setdefault(search_term, []).extend(contexts)
+
+    found_ids = []
+    for search_term, contexts in contexts_by_term.items():
+        for search_string in search_names[search_term]:
+            output_file_path = get_output_file_path(output_folder_path, search_string, file_path)
             try:
-                # Each thread creates its own Workbook object
-                workbook = Workbook()
-                sheet = workbook.active
-                sheet.title = "Data"
-
-                for context in contexts:
-                    for line_index, line in enumerate(context):
-                        # Split the line into columns by spaces
-                        columns = line.split()
-
-                        # Handle the first two lines as dates
-                        if line_index < 2:
-                            try:
-                                date_formats = ["%m/%d/%y", "%d-%m-%Y"]
-                                date = None
-                                for fmt in date_formats:
-                                    try:
-                                        date = datetime.strptime(columns[2], fmt)
-                                        break
-                                    except ValueError:
-                                        continue
-                                if date:
-                                    columns[2] = date.strftime("%m/%d/%Y")
-                            except (IndexError, ValueError):
-                                pass
-                        else:
-                            # Convert all numeric strings to numbers for subsequent lines
-                            for i in range(len(columns)):
-                                if isinstance(columns[i], str) and columns[i].isdigit():
-                                    columns[i] = int(columns[i])
-                                else:
-                                    try:
-                                        columns[i] = float(columns[i])
-                                    except ValueError:
-                                        pass
-
-                        # Write the processed row (columns) to the Excel sheet
-                        sheet.append(columns)
-
-                # Adjust column widths to fit the content
-                for column_cells in sheet.columns:
-                    max_length = 0
-                    column_letter = get_column_letter(column_cells[0].column)
-                    for cell in column_cells:
-                        try:
-                            if cell.value:
-                                max_length = max(max_length, len(str(cell.value)))
-                        except:
-                            pass
-                    adjusted_width = max_length + 2
-                    sheet.column_dimensions[column_letter].width = adjusted_width
-
-                # Save the workbook
-                workbook.save(output_file_path)
+                write_contexts_workbook(contexts, output_file_path)
             except Exception as e:
                 print(f"Error writing to file '{output_file_path}': {e}")
-    else:
-        print(f"The ID {search_string} was not found in any files.")
-        return search_string  # Return unfound ID for tracking
-
-    return None  # Return None if the ID was processed successfully
+            found_ids.append(search_string)
+    PerfStats.count("tasks_processed")
+    return found_ids, PerfStats.collect_worker_stats()
 
 
 if __name__ == "__main__":
+    # Profile the run as well when LYNCHLAB_PROFILE=1 is set (see PerfStats.py)
+    PerfStats.start_profiling()
+
+    # Ask the user for the output folder name
+    output_folder_name = str(input("Enter the name of the output folder (will replace duplicates): ") or "Results").strip()
+    output_folder_path = os.path.join(script_dir, output_folder_name)
+
+    # Optional filters (leave blank to search everything)
+    date_filters = []
+    for date_prompt in ("Search sessions from (YYYY-MM-DD, blank for the first): ", "Search sessions until (YYYY-MM-DD, blank for the last): "):
+        while True:
+            date_answer = input(date_prompt).strip()
+            date_filter = parse_date_filter(date_answer)
+            if date_filter or not date_answer:
+                break
+            print(f"'{date_answer}' is not a date in the form YYYY-MM-DD, please try again.")
+        date_filters.append(date_filter)
+    start_date, end_date = date_filters
+    rooms = [room.strip() for room in input("Rooms to search, separated by commas (blank for all): ").split(",") if room.strip()]
+    box_ranges = [box.strip() for box in input("Box ranges or boxes to search, separated by commas (blank for all): ").split(",") if box.strip()]
+
+    # Path to the unfound IDs file
+    unfound_ids_file_path = os.path.join(script_dir, "Unfound_IDs.txt") # Path to the unfound IDs file
+
+    # Check if the folder already exists and delete it if necessary
+    if os.path.exists(output_folder_path):
+        try:
+            shutil.rmtree(output_folder_path)
+            print(f"Existing folder '{output_folder_path}' deleted.")
+        except PermissionError:
+            print(f"Error: Unable to delete the existing folder '{output_folder_path}'. Please close any open files and try again.")
+            exit(1)
+
+    # Create the new output folder
+    os.makedirs(output_folder_path, exist_ok=True)
+    print(f"Output folder '{output_folder_path}' created.")
+
+    # Input file containing the list of animal ID file paths
+    id_file_list_path = os.path.join(script_dir, "ID List.txt")  # Path to the file containing ID file paths
+
+    # Read the IDs from "ID List.txt" and assign them to ID_list
+    ID_list = []
+    try:
+        with open(id_file_list_path, 'r', encoding='utf-8') as id_file_list:
+            ID_list = [line.strip() for line in id_file_list.readlines() if line.strip()]  # Read and strip each line, skipping blanks
+    except FileNotFoundError:
+        print(f"Error: The file '{id_file_list_path}' was not found.")
+        exit(1)
+    except PermissionError:
+        print(f"Error: Permission denied for the file '{id_file_list_path}'.")
+        exit(1)
+
+
+    valid_file_processed = True  # Flag to track if any valid files were processed
+    # Check if any IDs were loaded
+    if not ID_list:
+        valid_file_processed = False  # No valid files were processed
+        print("Error: No IDs were found in 'ID List.txt'.")
+        exit(1)
+
     if not valid_file_processed:
         print("No valid IDs found in the specified files.")
     elif not ID_list:
         print("No IDs were found in the valid files provided.")
     else:
-        unfound_ids = []  # List to track IDs that were not found
-
-        # Use ThreadPoolExecutor for multithreading
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(process_id, search_string): search_string for search_string in ID_list}
+        # Search terms (the IDs without quotes) mapped to the IDs as written in the ID list
+        search_names = {}
+        for search_string in ID_list:
+            names = search_names.setdefault(search_string.strip("'"), [])
+            if search_string not in names:
+                names.append(search_string)
+        search_terms = list(search_names)
+
+        # Only the files of the rooms and box ranges asked for are searched
+        data_files = [os.path.join(folder_path, rel_path) for rel_path in IDIndex.list_data_files(folder_path)]
+        data_files = [file_path for file_path in data_files if is_file_selected(file_path, rooms, box_ranges)]
+        if rooms or box_ranges:
+            print(f"Searching {len(data_files)} file(s) of the rooms and boxes selected.")
+
+        # Bring the ID index up to date (only changed files are parsed) and look the IDs up in it
+        indexed_results = {}
+        file_sessions = None
+        try:
+            with PerfStats.timer("index_update"):
+                updated_files = IDIndex.update_index(folder_path)
+            if updated_files:
+                print(f"Indexed {updated_files} changed file(s).")
+            indexed_results = IDIndex.lookup_ids(folder_path, search_terms, start_date, end_date)
+            if start_date or end_date:
+                file_sessions = IDIndex.lookup_sessions(folder_path, data_files)
+        except sqlite3.Error as e:
+            print(f"Error using the ID index, searching all files instead: {e}")
+
+        # IDs that are not a subject in the index fall back to searching the text of every file
+        unindexed_terms = [search_term for search_term in search_terms if search_term not in indexed_results]
+        if unindexed_terms:
+            print("Searching files for IDs not in the index...")
+
+        # With a date filter, the text search only covers the sessions in the date range (found through the index,
+        # or by reading the file if it is not indexed), and files without any are skipped
+        file_regions = {}
+        if unindexed_terms and (start_date or end_date):
+            for file_path in data_files:
+                if file_sessions is not None and file_path in file_sessions:
+                    sessions = file_sessions[file_path]
+                else:
+                    try:
+                        sessions = [(offset, length, session_date) for _, offset, length, session_date in IDIndex.find_session_blocks(file_path)]
+                    except (OSError, ValueError):
+                        sessions = None  # Searched in full, reporting the error
+                if sessions is not None:
+                    file_regions[file_path] = get_date_regions(sessions, start_date, end_date)
+
+        # Tasks of one file and a batch of IDs. The text of a file is searched once, by one task, for all the IDs
+        # that are not indexed (those go first, as they take longest); the IDs with blocks in the file are split
+        # into batches of ids_per_task, each reading only the blocks of its IDs
+        tasks = []
+        for file_path in data_files:
+            if unindexed_terms and file_regions.get(file_path) != []:
+                tasks.append((file_path, {}, unindexed_terms))
+        for file_path in data_files:
+            file_terms = [search_term for search_term, files in indexed_results.items() if file_path in files]
+            for batch_start in range(0, len(file_terms), ids_per_task):
+                batch_terms = file_terms[batch_start:batch_start + ids_per_task]
+                tasks.append((file_path, {search_term: indexed_results[search_term][file_path] for search_term in batch_terms}, []))
+
+        found_ids = set()
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        # Tasks on threads are profiled along with the main thread when profiling is on (worker processes are not,
+        # see PerfStats.py for profiling them with py-spy)
+        task_function = process_file if use_processes else PerfStats.profiled(process_file)
+
+        # Worker processes start without timings of their own (when forked they would inherit the main process's)
+        executor_options = {"initializer": PerfStats.reset} if use_processes else {}
+        # No more workers are started than there are tasks
+        with executor_class(max_workers=max(1, min(num_workers, len(tasks))), **executor_options) as executor:
+            futures = {}
+            for file_path, file_blocks, scan_terms in tasks:
+                task_names = {search_term: search_names[search_term] for search_term in list(file_blocks) + scan_terms}
+                future = executor.submit(task_function, file_path, task_names, file_blocks, scan_terms, output_folder_path,
+                                         file_regions.get(file_path))
+                futures[future] = file_path
 
             # Use tqdm to track progress
-            with tqdm(total=len(ID_list), desc="Processing IDs", unit="ID") as pbar:
+            with tqdm(total=len(futures), desc="Processing files", unit="task") as pbar:
                 for future in as_completed(futures):
-                    search_string = futures[future]
+                    file_path = futures[future]
                     try:
-                        result = future.result()
-                        if result:  # If the ID was not found
-                            unfound_ids.append(result)
+                        file_found_ids, worker_stats = future.result()
+                        found_ids.update(file_found_ids)
+                        PerfStats.merge_stats(worker_stats)
                     except Exception as e:
-                        print(f"Error processing ID '{search_string}': {e}")
+                        print(f"Error processing file '{file_path}': {e}")
                     finally:
                         pbar.update(1)
 
-# Check if the unfound IDs file already exists and delete it if necessary
-if os.path.exists(unfound_ids_file_path):
+        unfound_ids = []  # List to track IDs that were not found
+        for search_string in ID_list:
+            if search_string not in found_ids and search_string not in unfound_ids:
+                print(f"The ID {search_string} was not found in any files.")
+                unfound_ids.append(search_string)
+
+        # Save the timings of the run
+        if write_performance_report:
+            try:
+                report_path = PerfStats.write_report(os.path.join(script_dir, "Reports"), "IDFinder")
+                print(f"Performance report saved to '{report_path}'.")
+            except Exception as e:
+                print(f"Error writing the performance report: {e}")
+
+    # Check if the unfound IDs file already exists and delete it if necessary
+    if os.path.exists(unfound_ids_file_path):
+        try:
+            shutil.rmtree(unfound_ids_file_path)
+            print(f"Existing file '{unfound_ids_file_path}' deleted.")
+        except PermissionError:
+            print(f"Error: Unable to delete the existing file '{unfound_ids_file_path}'. Please close any open files and try again.")
+            exit(1)
+        os.makedirs(unfound_ids_file_path, exist_ok=True)
+        print(f"Output file '{unfound_ids_file_path}' created.")
+
+    # Save the list of unfound IDs to a .txt file
     try:
-        shutil.rmtree(unfound_ids_file_path)
-        print(f"Existing file '{unfound_ids_file_path}' deleted.")
-    except PermissionError:
-        print(f"Error: Unable to delete the existing file '{unfound_ids_file_path}'. Please close any open files and try again.")
-        exit(1)
-    os.makedirs(unfound_ids_file_path, exist_ok=True)
-    print(f"Output file '{unfound_ids_file_path}' created.")
-
-# Save the list of unfound IDs to a .txt file
-try:
-    with open(unfound_ids_file_path, 'w', encoding='utf-8') as unfound_file:
-        if unfound_ids:
-            unfound_file.write("The following IDs were not found:\n")
-            for unfound_id in unfound_ids:
-                unfound_file.write(f"{unfound_id}\n")
-            # Write the unfound IDs to the file
-            print(f"\nUnfound IDs have been saved to '{unfound_ids_file_path}'.")
-        else:
-            unfound_file.write("All IDs were found in the files.")
-except Exception as e:
-    print(f"Error writing to 'Unfound_IDs.txt': {e}")
\ No newline at end of file
+        with open(unfound_ids_file_path, 'w', encoding='utf-8') as unfound_file:
+            if unfound_ids:
+                unfound_file.write("The following IDs were not found:\n")
+                for unfound_id in unfound_ids:
+                    unfound_file.write(f"{unfound_id}\n")
+                # Write the unfound IDs to the file
+                print(f"\nUnfound IDs have been saved to '{unfound_ids_file_path}'.")
+            else:
+                unfound_file.write("All IDs were found in the files.")
+    except Exception as e:
+        print(f"Error writing to 'Unfound_IDs.txt': {e}")
\ No newline at end of file
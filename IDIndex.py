@@ -0,0 +1,306 @@
+import os
+import re  # Import for locating the session blocks in the merged files
+import sqlite3  # Import for the on-disk index
+import mmap  # Import for scanning large files without reading them into memory
+import sys
+from datetime import datetime
+from functools import lru_cache
+import CompressedBox  # Import for indexing compressed merged files
+import ContextRows  # Import for the session date formats
+
+# Name of the index file kept inside the merged data folder (hidden so the text search skips it)
+index_file_name = ".id_index.sqlite"
+
+# Name of the file the merger leaves in a data folder once its merge has finished
+merge_complete_file_name = ".merge_complete"
+
+# Bump this when the layout of the index changes so old indexes are rebuilt
+index_version = 2
+
+# "Subject: <ID>" header line of a session block
+subject_pattern = re.compile(rb"^Subject:[ \t]*(\S[^\r\n]*)", re.MULTILINE)
+
+# "Start Date: <date>" header line of a session block
+start_date_pattern = re.compile(rb"^Start Date:[ \t]*(\S+)", re.MULTILINE)
+
+# First blank (or whitespace-only) line, which ends a session block
+blank_line_pattern = re.compile(rb"^[ \t\r\f\v]*$\n?", re.MULTILINE)
+
+def get_index_path(folder_path):
+    """
+    Return the path of the index file for a merged data folder.
+    """
+    return os.path.join(folder_path, index_file_name)
+
+def open_index(folder_path):
+    """
+    Open (and create if needed) the index database for a merged data folder.
+    """
+    conn = sqlite3.connect(get_index_path(folder_path))
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != index_version:
+        # Layout changed, start over
+        conn.execute("DROP TABLE IF EXISTS files")
+        conn.execute("DROP TABLE IF EXISTS blocks")
+        conn.execute(f"PRAGMA user_version = {index_version}")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS blocks (subject TEXT, path TEXT, offset INTEGER, length INTEGER, session_date TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS blocks_subject ON blocks (subject)")
+    conn.execute("CREATE INDEX IF NOT EXISTS blocks_path ON blocks (path)")
+    return conn
+
+def list_data_files(folder_path):
+    """
+    List the merged data files in a folder, relative to the folder. Hidden files (index, manifests) are skipped.
+    """
+    data_files = []
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            if file.startswith("."):
+                continue
+            data_files.append(os.path.relpath(os.path.join(root, file), folder_path))
+    return sorted(data_files)
+
+def find_session_blocks(file_path):
+    """
+    Find every session block in a merged file. A block runs from two lines above its "Subject:" line
+    until one empty line is encountered, the same context IDFinder copies for a match.
+
+    Args:
+        file_path (str): Path to the merged file.
+
+    Returns:
+        list: (subject, offset, length, session date) tuples, one per block, the session date being
+        YYYY-MM-DD or None if the block has no readable "Start Date:" line. In a compressed file the
+        offsets are in the uncompressed text.
+    """
+    blocks = []
+    if os.path.getsize(file_path) == 0:
+        return blocks
+
+    if CompressedBox.is_compressed(file_path):
+        for frame, data, _ in CompressedBox.iter_frames(file_path):
+            blocks.extend((subject, frame["start"] + offset, length, session_date)
+                          for subject, offset, length, session_date in find_data_blocks(data))
+        return blocks
+
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        blocks.extend(find_data_blocks(data))
+    return blocks
+
+def find_data_blocks(data):
+    """
+    Find every session block in some merged text (see find_session_blocks).
+    """
+    blocks = []
+    for match in subject_pattern.finditer(data):
+        start, end = find_block(data, match.start())
+        subject = match.group(1).decode("utf-8", errors="replace").strip()
+        date_match = start_date_pattern.search(data, start, match.start())
+        blocks.append((subject, start, end - start, parse_session_date(date_match.group(1)) if date_match else None))
+    return blocks
+
+@lru_cache(maxsize=4096)
+def parse_session_date(date_str):
+    """
+    Turn the date of a "Start Date:" line (as bytes) into YYYY-MM-DD, or None if it is in none of the known formats.
+    """
+    for fmt in ContextRows.date_formats:
+        try:
+            return datetime.strptime(date_str.decode("ascii", errors="replace"), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def find_block(data, line_start):
+    """
+    Find the context block around a matching line: from two lines above it until (and including)
+    the first empty line.
+
+    Args:
+        data (bytes or mmap): The file content.
+        line_start (int): Offset of the start of the matching line.
+
+    Returns:
+        tuple: (start, end) offsets of the block.
+    """
+    # Step back two lines from the matching line
+    start = line_start
+    for _ in range(2):
+        if start == 0:
+            break
+        start = data.rfind(b"\n", 0, start - 1) + 1
+
+    # Run until (and including) the first empty line
+    blank_line = blank_line_pattern.search(data, start)
+    end = blank_line.end() if blank_line else len(data)
+    return start, end
+
+def update_index(folder_path):
+    """
+    Bring the index of a merged data folder up to date. Files whose mtime or size changed since they
+    were indexed are parsed again, and files that no longer exist are dropped from the index.
+
+    Args:
+        folder_path (str): Path to the merged data folder.
+
+    Returns:
+        int: The number of files that were (re)indexed.
+    """
+    conn = open_index(folder_path)
+    try:
+        indexed = {path: (mtime_ns, size) for path, mtime_ns, size in conn.execute("SELECT path, mtime_ns, size FROM files")}
+        data_files = list_data_files(folder_path)
+        updated = 0
+
+        for rel_path in data_files:
+            file_path = os.path.join(folder_path, rel_path)
+            stat = os.stat(file_path)
+            if indexed.get(rel_path) == (stat.st_mtime_ns, stat.st_size):
+                continue  # Unchanged since it was indexed
+
+            try:
+                blocks = find_session_blocks(file_path)
+            except (OSError, ValueError) as e:
+                print(f"Error indexing file: {file_path} ({e})")
+                continue
+
+            with conn:
+                conn.execute("DELETE FROM blocks WHERE path = ?", (rel_path,))
+                conn.executemany("INSERT INTO blocks (subject, path, offset, length, session_date) VALUES (?, ?, ?, ?, ?)",
+                                 [(subject, rel_path, offset, length, session_date) for subject, offset, length, session_date in blocks])
+                conn.execute("INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                             (rel_path, stat.st_mtime_ns, stat.st_size))
+            updated += 1
+
+        # Drop files that were removed from the folder
+        removed = set(indexed) - set(data_files)
+        with conn:
+            for rel_path in removed:
+                conn.execute("DELETE FROM blocks WHERE path = ?", (rel_path,))
+                conn.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+    finally:
+        conn.close()
+    return updated
+
+def lookup_ids(folder_path, search_strings, start_date=None, end_date=None):
+    """
+    Look up the session blocks of several IDs in the index.
+
+    Args:
+        folder_path (str): Path to the merged data folder.
+        search_strings (iterable): The IDs to look up.
+        start_date (str): Only sessions on or after this date (YYYY-MM-DD), or None.
+        end_date (str): Only sessions on or before this date (YYYY-MM-DD), or None.
+
+    Returns:
+        dict: A dictionary where keys are IDs and values are dictionaries mapping file paths
+        to lists of (offset, length) tuples, in file order. IDs that are not indexed are left out. With a
+        date filter, sessions without a date are left out, and an ID with no session in the date range maps
+        to an empty dictionary (it is still a subject, so its sessions need not be searched for in the text).
+    """
+    query = "SELECT path, offset, length FROM blocks WHERE subject = ?"
+    date_filters = []
+    if start_date:
+        query += " AND session_date >= ?"
+        date_filters.append(start_date)
+    if end_date:
+        query += " AND session_date <= ?"
+        date_filters.append(end_date)
+    query += " ORDER BY path, offset"
+
+    results = {}
+    conn = open_index(folder_path)
+    try:
+        for search_string in set(search_strings):
+            if date_filters and conn.execute("SELECT 1 FROM blocks WHERE subject = ? LIMIT 1", (search_string,)).fetchone():
+                results[search_string] = {}
+            for rel_path, offset, length in conn.execute(query, [search_string] + date_filters):
+                file_path = os.path.join(folder_path, rel_path)
+                results.setdefault(search_string, {}).setdefault(file_path, []).append((offset, length))
+    finally:
+        conn.close()
+    return results
+
+def lookup_sessions(folder_path, file_paths):
+    """
+    Look up where the sessions of some merged files are and their dates, e.g. to search only the
+    sessions of a date range.
+
+    Args:
+        folder_path (str): Path to the merged data folder.
+        file_paths (iterable): Paths of the files in the folder.
+
+    Returns:
+        dict: The file paths mapped to lists of (offset, length, session date) tuples, in file order.
+        Files that are not indexed are left out.
+    """
+    sessions = {}
+    conn = open_index(folder_path)
+    try:
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, folder_path)
+            if conn.execute("SELECT 1 FROM files WHERE path = ?", (rel_path,)).fetchone():
+                sessions[file_path] = conn.execute("SELECT offset, length, session_date FROM blocks WHERE path = ? ORDER BY offset",
+                                                   (rel_path,)).fetchall()
+    finally:
+        conn.close()
+    return sessions
+
+def load_index(folder_path):
+    """
+    Load the whole index of a merged data folder, e.g. to keep it in memory.
+
+    Returns:
+        tuple: (files, blocks) where files maps the path of every indexed file (relative to the folder) to
+        (mtime_ns, size) when it was indexed, and blocks maps every subject to a list of
+        (path, offset, length, session date) tuples, in file order.
+    """
+    conn = open_index(folder_path)
+    try:
+        files = {path: (mtime_ns, size) for path, mtime_ns, size in conn.execute("SELECT path, mtime_ns, size FROM files")}
+        blocks = {}
+        for subject, rel_path, offset, length, session_date in conn.execute(
+                "SELECT subject, path, offset, length, session_date FROM blocks ORDER BY path, offset"):
+            blocks.setdefault(subject, []).append((rel_path, offset, length, session_date))
+    finally:
+        conn.close()
+    return files, blocks
+
+def read_block_context(f, offset, length):
+    """
+    Read one indexed session block from an open (binary) file and return its lines the way
+    IDFinder copies them: stripped, without "File:" lines, ending with the empty line.
+    """
+    f.seek(offset)
+    return block_context(f.read(length))
+
+def block_context(block):
+    """
+    Turn the bytes of a block (see find_block) into its lines the way IDFinder copies them:
+    stripped, without "File:" lines, ending with the empty line. Bytes that are not valid UTF-8
+    are replaced rather than hiding the block.
+    """
+    text = block.decode("utf-8", errors="replace")
+    lines = text.split("\n")
+    if text.endswith("\n"):
+        lines.pop()  # Nothing follows the last newline
+    context = []
+    for line in lines:
+        current_line = line.strip()
+        if not current_line.lower().startswith("file:"):
+            context.append(current_line)
+        if current_line == "":
+            break
+    return context
+
+
+if __name__ == "__main__":
+    # Build or refresh the index of a merged data folder: python IDIndex.py [folder]
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    data_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(script_dir, "Data")
+    if not os.path.isdir(data_folder):
+        print(f"Error: The folder '{data_folder}' was not found.")
+        sys.exit(1)
+    updated_files = update_index(data_folder)
+    print(f"Indexed {updated_files} changed file(s) in '{data_folder}'.")
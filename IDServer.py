@@ -0,0 +1,338 @@
+import os
+import re  # Import for finding the merged data folders
+import io
+import csv  # Import for the CSV answers
+import json
+import sqlite3  # Import for handling errors from the ID index
+import sys
+import time
+from datetime import datetime
+from threading import Lock, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from openpyxl import Workbook
+import IDIndex  # Import for the animal ID index
+import IDFinder  # Import for reading the session blocks and writing the sheets
+import ContextRows  # Import for converting the context lines to rows
+import PerfStats  # Import for the query timings
+
+# A long-running query service for the merged data: the ID index is loaded into memory once and kept up to date
+# as new merges finish, so a query only reads the session blocks it returns. Start it with
+# python IDServer.py [data folder] and ask it for the sessions of some IDs, e.g.
+#   http://127.0.0.1:8765/sessions?ids=4001,4002&start=2018-01-01&end=2018-12-31&format=xlsx
+# format is json (default; the rows of each session), csv or xlsx (one sheet per ID and box file, like IDFinder).
+# /status describes the data being served. Only IDs that are the subject of a session are found (like the index).
+
+# Address the server listens on (only this computer by default; use "0.0.0.0" to serve the lab network)
+host = os.environ.get("LYNCHLAB_ID_SERVER_HOST", "127.0.0.1")
+port = int(os.environ.get("LYNCHLAB_ID_SERVER_PORT", "8765"))
+
+# Seconds between checks for a newly finished merge or changed files
+poll_interval = 30
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Folder given on the command line; without one the newest finished "Data_YYYY-MM-DD" folder is served (else "Data")
+data_folder = None
+
+# The index being served, replaced as a whole when it is reloaded so queries always see one consistent version
+index_lock = Lock()  # Only one refresh at a time
+loaded_index = {"folder": None, "files": {}, "blocks": {}, "loaded_at": None}
+
+def find_data_folder():
+    """
+    Return the merged data folder to serve: the one given on the command line, or the newest "Data_YYYY-MM-DD"
+    folder whose merge has finished, or the "Data" folder IDFinder uses. Returns None if there is none.
+    """
+    if data_folder is not None:
+        return data_folder if os.path.isdir(data_folder) else None
+    merged_folders = sorted((folder_name for folder_name in os.listdir(script_dir)
+                             if re.fullmatch(r"Data_\d{4}-\d{2}-\d{2}", folder_name)
+                             and os.path.exists(os.path.join(script_dir, folder_name, IDIndex.merge_complete_file_name))),
+                            reverse=True)
+    if merged_folders:
+        return os.path.join(script_dir, merged_folders[0])
+    return IDFinder.folder_path if os.path.isdir(IDFinder.folder_path) else None
+
+def refresh_index():
+    """
+    Bring the in-memory index up to date: switch to a newer merged data folder, index any file that changed,
+    and reload the index if anything did.
+
+    Returns:
+        bool: True if the index was reloaded.
+    """
+    global loaded_index
+    with index_lock:
+        folder = find_data_folder()
+        if folder is None:
+            if loaded_index["folder"] is not None and not os.path.isdir(loaded_index["folder"]):
+                loaded_index = {"folder": None, "files": {}, "blocks": {}, "loaded_at": None}  # The folder went away
+            return False
+
+        with PerfStats.timer("index_update"):
+            updated_files = IDIndex.update_index(folder)
+        if not updated_files and folder == loaded_index["folder"] and set(IDIndex.list_data_files(folder)) == set(loaded_index["files"]):
+            return False
+
+        with PerfStats.timer("index_load"):
+            files, blocks = IDIndex.load_index(folder)
+        loaded_index = {"folder": folder, "files": files, "blocks": blocks, "loaded_at": datetime.now().isoformat(timespec="seconds")}
+        print(f"Serving '{folder}': {len(files)} file(s), {len(blocks)} ID(s).")
+        return True
+
+def watch_data_folders():
+    """
+    Check for new merges and changed files every poll_interval seconds (run on a background thread).
+    """
+    while True:
+        time.sleep(poll_interval)
+        try:
+            refresh_index()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error refreshing the ID index: {e}")
+
+def is_index_current(index, rel_paths):
+    """
+    Check whether files are still the same as when they were indexed (a merge may have rewritten them since).
+    """
+    for rel_path in rel_paths:
+        try:
+            stat = os.stat(os.path.join(index["folder"], rel_path))
+        except OSError:
+            return False
+        if index["files"].get(rel_path) != (stat.st_mtime_ns, stat.st_size):
+            return False
+    return True
+
+def find_sessions(search_ids, start_date=None, end_date=None, rooms=None, box_ranges=None):
+    """
+    Find the sessions of some IDs, optionally only those from a date range or some rooms and boxes.
+
+    Args:
+        search_ids (list): The IDs to look up (quotes around them are ignored, as in the ID list).
+        start_date (str): First session date to include (YYYY-MM-DD), or None.
+        end_date (str): Last session date to include (YYYY-MM-DD), or None.
+        rooms (list): Rooms to include, or None for every room (see IDFinder.is_file_selected).
+        box_ranges (list): Box ranges or boxes to include, or None for every box.
+
+    Returns:
+        tuple: (sessions, not found) where sessions is a list of dictionaries with the keys "id", "file",
+        "session_date" and "context" (the lines of the session block), by ID, file and position in the file,
+        and not found lists the IDs without any session (in the date range, rooms and boxes). None if no merged
+        data is available any more (e.g. a merge has just moved the folder being served).
+    """
+    search_terms = list(dict.fromkeys(search_id.strip().strip("'") for search_id in search_ids if search_id.strip()))
+
+    def select_blocks(index):
+        # Blocks of each ID in the date range and boxes, by file (sessions without a readable date only match without a range)
+        selected = {}
+        for search_term in search_terms:
+            for rel_path, offset, length, session_date in index["blocks"].get(search_term, []):
+                if not IDFinder.is_file_selected(rel_path, rooms, box_ranges):
+                    continue
+                if (start_date or end_date) and session_date is None:
+                    continue
+                if (start_date and session_date < start_date) or (end_date and session_date > end_date):
+                    continue
+                selected.setdefault(search_term, {}).setdefault(rel_path, []).append((offset, length, session_date))
+        return selected
+
+    index = loaded_index
+    if not is_index_current(index, index["files"]):
+        refresh_index()  # Some files changed since they were indexed
+        index = loaded_index
+        if index["folder"] is None:
+            return None
+    selected = select_blocks(index)
+
+    # Read the blocks of every ID from each file, opening the file once
+    blocks_by_file = {}
+    for search_term, files in selected.items():
+        for rel_path, blocks in files.items():
+            blocks_by_file.setdefault(rel_path, {})[search_term] = blocks
+    contexts = {}
+    for rel_path, file_blocks in blocks_by_file.items():
+        file_contexts = IDFinder.read_indexed_contexts_in_file(
+            os.path.join(index["folder"], rel_path), [[(offset, length) for offset, length, _ in blocks] for blocks in file_blocks.values()])
+        for search_term, block_contexts in zip(file_blocks, file_contexts):
+            contexts[search_term, rel_path] = block_contexts
+
+    sessions = []
+    for search_term, files in selected.items():
+        for rel_path, blocks in files.items():
+            for (_, _, session_date), context in zip(blocks, contexts[search_term, rel_path]):
+                sessions.append({"id": search_term, "file": rel_path, "session_date": session_date, "context": context})
+    not_found = [search_term for search_term in search_terms if search_term not in selected]
+    return sessions, not_found
+
+def get_sheet_title(search_id, file):
+    """
+    Return the sheet name for the sessions of one ID in one file, named like IDFinder's workbooks
+    (Excel allows 31 characters and no []:*?/\\).
+    """
+    title = os.path.splitext(os.path.basename(IDFinder.get_output_file_path("", search_id, file)))[0]
+    return re.sub(r"[\[\]:*?/\\]", "_", title)[:31]
+
+def get_json_answer(sessions, not_found):
+    """
+    Answer with every session as its rows (see ContextRows), in JSON.
+    """
+    answer = {
+        "folder": os.path.basename(loaded_index["folder"] or ""),
+        "sessions": [{"id": session["id"], "file": session["file"], "session_date": session["session_date"],
+                      "rows": ContextRows.get_rows([session["context"]])[0]} for session in sessions],
+        "not_found": not_found,
+    }
+    return json.dumps(answer).encode("utf-8")
+
+def get_csv_answer(sessions):
+    """
+    Answer with one CSV row per line of every session, each starting with the ID, file and session date.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    for session in sessions:
+        rows, _ = ContextRows.get_rows([session["context"]])
+        for row in rows:
+            writer.writerow([session["id"], session["file"], session["session_date"] or ""] + row)
+    return output.getvalue().encode("utf-8")
+
+def get_xlsx_answer(sessions):
+    """
+    Answer with a workbook holding one sheet per ID and file, as IDFinder writes them.
+    """
+    contexts = {}
+    for session in sessions:
+        contexts.setdefault((session["id"], session["file"]), []).append(session["context"])
+    workbook = Workbook(write_only=True)
+    for (search_id, file), file_contexts in contexts.items():
+        IDFinder.add_contexts_sheet(workbook, get_sheet_title(search_id, file), file_contexts)
+    if not contexts:
+        workbook.create_sheet("Data")  # A workbook needs at least one sheet
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+def get_status():
+    """
+    Describe the data being served, with the query timings so far.
+    """
+    index = loaded_index
+    report = PerfStats.get_report()
+    return json.dumps({
+        "folder": index["folder"],
+        "loaded_at": index["loaded_at"],
+        "files": len(index["files"]),
+        "ids": len(index["blocks"]),
+        "sessions": sum(len(blocks) for blocks in index["blocks"].values()),
+        "timings": report["histograms"],
+        "counters": report["counters"],
+    }, indent=1).encode("utf-8")
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers /sessions and /status requests (each on a thread of its own).
+    """
+    content_types = {
+        "json": "application/json",
+        "csv": "text/csv; charset=utf-8",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/status":
+            self.send_answer(200, "application/json", get_status())
+            return
+        if url.path != "/sessions":
+            self.send_error(404, "Use /sessions?ids=... or /status")
+            return
+
+        search_ids = [search_id for value in query.get("ids", []) for search_id in value.split(",")]
+        start_date = query.get("start", [None])[0]
+        end_date = query.get("end", [None])[0]
+        rooms = [room.strip() for value in query.get("rooms", []) for room in value.split(",") if room.strip()]
+        box_ranges = [box.strip() for value in query.get("boxes", []) for box in value.split(",") if box.strip()]
+        answer_format = query.get("format", ["json"])[0]
+        try:
+            for date_str in (start_date, end_date):
+                if date_str:
+                    datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            self.send_error(400, "Dates must be given as YYYY-MM-DD")
+            return
+        if not search_ids or answer_format not in self.content_types:
+            self.send_error(400, "Give the IDs as ids=... and the format as json, csv or xlsx")
+            return
+        if loaded_index["folder"] is None:
+            try:
+                refresh_index()  # A merge may have finished since the last check
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error refreshing the ID index: {e}")
+        if loaded_index["folder"] is None:
+            self.send_error(503, "No merged data is available yet")
+            return
+
+        try:
+            with PerfStats.timer(f"query_{answer_format}"):
+                found = find_sessions(search_ids, start_date, end_date, rooms, box_ranges)
+                if found is None:
+                    self.send_error(503, "No merged data is available right now")
+                    return
+                sessions, not_found = found
+                if answer_format == "csv":
+                    body = get_csv_answer(sessions)
+                elif answer_format == "xlsx":
+                    body = get_xlsx_answer(sessions)
+                else:
+                    body = get_json_answer(sessions, not_found)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Error answering '{self.path}': {e}")
+            self.send_error(500, "The sessions could not be read")
+            return
+        PerfStats.count("queries")
+        self.send_answer(200, self.content_types[answer_format], body,
+                         "sessions.xlsx" if answer_format == "xlsx" else None)
+
+    def send_answer(self, status, content_type, body, file_name=None):
+        """
+        Send a complete answer.
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if file_name:
+            self.send_header("Content-Disposition", f'attachment; filename="{file_name}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    # Serve a data folder (default: the newest finished merge): python IDServer.py [data folder]
+    if len(sys.argv) > 1:
+        data_folder = os.path.abspath(sys.argv[1])
+        if not os.path.isdir(data_folder):
+            print(f"Error: The folder '{data_folder}' was not found.")
+            sys.exit(1)
+
+    try:
+        refresh_index()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error loading the ID index: {e}")
+    if loaded_index["folder"] is None:
+        print("No merged data folder yet, waiting for a merge to finish.")
+
+    Thread(target=watch_data_folders, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), QueryHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.request_queue_size = 128  # Room for many users connecting at once (the default is 5)
+    server.server_bind()
+    server.server_activate()
+    print(f"Answering queries on http://{host}:{port}/sessions?ids=... (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,240 @@
+import os
+import csv  # Import for the CSV version of the report
+import json
+import time
+import cProfile  # Import for the optional profile of the run
+import pstats
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+# Timing counters and histograms for the hot paths of the scripts, written as a JSON and a CSV report at the
+# end of each run (see write_report). Set LYNCHLAB_PROFILE=1 to also profile the run with cProfile; the
+# profile is saved next to the report as a .prof file (open it with pstats or snakeviz). Sampling profilers
+# such as py-spy need no switch: py-spy record --subprocesses -- python IDFinder.py
+
+# Profile the run with cProfile
+profiling = os.environ.get("LYNCHLAB_PROFILE", "") not in ("", "0")
+
+# Upper bounds of the histogram buckets in seconds: 0.1 ms doubling up to about 30 minutes
+bucket_bounds = [0.0001 * 2 ** i for i in range(25)]
+
+stats_lock = Lock()
+counters = {}  # Name mapped to a count
+histograms = {}  # Name mapped to {"count", "total", "min", "max", "buckets"}
+throughputs = {}  # Name mapped to [amount, seconds]
+started_at = time.time()
+
+# Profiles of the tasks run through profiled(), and the profile of the main thread
+task_profiles = []
+main_profile = None
+
+def count(name, amount=1):
+    """
+    Add to a counter.
+    """
+    with stats_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+def record(name, seconds):
+    """
+    Add a duration to a histogram.
+    """
+    bucket = 0
+    while bucket < len(bucket_bounds) - 1 and seconds > bucket_bounds[bucket]:
+        bucket += 1
+    with stats_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {"count": 0, "total": 0.0, "min": seconds, "max": seconds, "buckets": [0] * len(bucket_bounds)}
+        histogram["count"] += 1
+        histogram["total"] += seconds
+        histogram["min"] = min(histogram["min"], seconds)
+        histogram["max"] = max(histogram["max"], seconds)
+        histogram["buckets"][bucket] += 1
+
+def add_throughput(name, amount, seconds):
+    """
+    Add an amount of work (e.g. bytes) done in a number of seconds, reported as a rate per second.
+    """
+    with stats_lock:
+        totals = throughputs.setdefault(name, [0, 0.0])
+        totals[0] += amount
+        totals[1] += seconds
+
+@contextmanager
+def timer(name):
+    """
+    Time a block of code into a histogram (also when it raises).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def queued(name, function):
+    """
+    Wrap a function about to be queued on an executor so the time it waits in the queue is recorded.
+    """
+    queued_at = time.perf_counter()
+
+    def run(*args, **kwargs):
+        record(name, time.perf_counter() - queued_at)
+        return function(*args, **kwargs)
+    return run
+
+def profiled(function):
+    """
+    Wrap a function run on a worker thread so it is profiled when profiling is on (cProfile only sees the
+    thread it was started in).
+    """
+    if not profiling:
+        return function
+
+    def run(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            with stats_lock:
+                task_profiles.append(profile)
+    return run
+
+def start_profiling():
+    """
+    Start profiling the main thread, if profiling is on.
+    """
+    global main_profile
+    if profiling and main_profile is None:
+        main_profile = cProfile.Profile()
+        main_profile.enable()
+
+def reset():
+    """
+    Drop the statistics gathered so far, e.g. the ones a forked worker process inherits from its parent.
+    """
+    with stats_lock:
+        counters.clear()
+        histograms.clear()
+        throughputs.clear()
+
+def collect_worker_stats():
+    """
+    In a worker process, return the statistics gathered so far and start over, so the parent process can add
+    them with merge_stats. Returns None in the main process, where the statistics are already in place.
+    """
+    if multiprocessing.parent_process() is None:
+        return None
+    with stats_lock:
+        stats = {"counters": dict(counters), "histograms": dict(histograms), "throughputs": dict(throughputs)}
+    reset()
+    return stats
+
+def merge_stats(stats):
+    """
+    Add the statistics of a worker process (see collect_worker_stats).
+    """
+    if not stats:
+        return
+    with stats_lock:
+        for name, amount in stats["counters"].items():
+            counters[name] = counters.get(name, 0) + amount
+        for name, worker_histogram in stats["histograms"].items():
+            histogram = histograms.get(name)
+            if histogram is None:
+                histograms[name] = worker_histogram
+                continue
+            histogram["count"] += worker_histogram["count"]
+            histogram["total"] += worker_histogram["total"]
+            histogram["min"] = min(histogram["min"], worker_histogram["min"])
+            histogram["max"] = max(histogram["max"], worker_histogram["max"])
+            histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], worker_histogram["buckets"])]
+        for name, (amount, seconds) in stats["throughputs"].items():
+            totals = throughputs.setdefault(name, [0, 0.0])
+            totals[0] += amount
+            totals[1] += seconds
+
+def get_percentile(histogram, fraction):
+    """
+    Estimate a percentile of a histogram from its buckets (the upper bound of the bucket it falls in).
+    """
+    target = fraction * histogram["count"]
+    seen = 0
+    for bound, bucket_count in zip(bucket_bounds, histogram["buckets"]):
+        seen += bucket_count
+        if seen >= target:
+            return min(bound, histogram["max"])
+    return histogram["max"]
+
+def get_report():
+    """
+    Summarize the statistics gathered so far.
+
+    Returns:
+        dict: "counters", "histograms" (count, total, mean, min, p50, p90, p99 and max in seconds)
+        and "throughputs" (amount, seconds and per_second).
+    """
+    with stats_lock:
+        report = {
+            "started": datetime.fromtimestamp(started_at).isoformat(timespec="seconds"),
+            "seconds": time.time() - started_at,
+            "counters": dict(sorted(counters.items())),
+            "histograms": {},
+            "throughputs": {},
+        }
+        for name, histogram in sorted(histograms.items()):
+            report["histograms"][name] = {
+                "count": histogram["count"],
+                "total": histogram["total"],
+                "mean": histogram["total"] / histogram["count"],
+                "min": histogram["min"],
+                "p50": get_percentile(histogram, 0.5),
+                "p90": get_percentile(histogram, 0.9),
+                "p99": get_percentile(histogram, 0.99),
+                "max": histogram["max"],
+            }
+        for name, (amount, seconds) in sorted(throughputs.items()):
+            report["throughputs"][name] = {"amount": amount, "seconds": seconds,
+                                           "per_second": amount / seconds if seconds > 0 else None}
+    return report
+
+def write_report(report_folder, run_name):
+    """
+    Write the report of the run as "<run name>_<date>_<time>.json" and ".csv" in the report folder,
+    and the profile as ".prof" when profiling is on.
+
+    Returns:
+        str: Path of the JSON report.
+    """
+    os.makedirs(report_folder, exist_ok=True)
+    report_path = os.path.join(report_folder, f"{run_name}_{datetime.now():%Y-%m-%d_%H%M%S}")
+    report = get_report()
+
+    with open(report_path + ".json", "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=1)
+
+    # One row per metric
+    with open(report_path + ".csv", "w", newline="", encoding="utf-8") as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(["metric", "kind", "count", "total", "mean", "min", "p50", "p90", "p99", "max", "per_second"])
+        for name, value in report["counters"].items():
+            writer.writerow([name, "counter", value, "", "", "", "", "", "", "", ""])
+        for name, summary in report["histograms"].items():
+            writer.writerow([name, "seconds", summary["count"], summary["total"], summary["mean"], summary["min"],
+                             summary["p50"], summary["p90"], summary["p99"], summary["max"], ""])
+        for name, summary in report["throughputs"].items():
+            writer.writerow([name, "throughput", "", summary["amount"], "", "", "", "", "", "", summary["per_second"]])
+
+    # Combine the profiles of the main thread and the worker tasks into one
+    profiles = ([main_profile] if main_profile is not None else []) + task_profiles
+    if profiles:
+        if main_profile is not None:
+            main_profile.disable()
+        profile_stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            profile_stats.add(profile)
+        profile_stats.dump_stats(report_path + ".prof")
+
+    return report_path + ".json"
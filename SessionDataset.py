@@ -0,0 +1,204 @@
+import os
+import shutil
+from datetime import datetime
+import ContextRows  # Import for the session date formats (shared with the ID index)
+
+# pyarrow is optional: without it the merger only writes the combined text files
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# Header lines of a session block and the column each one is stored in
+header_fields = {
+    "Start Date": "start_date",
+    "End Date": "end_date",
+    "Subject": "subject",
+    "Experiment": "experiment",
+    "Group": "group",
+    "Box": "box_number",
+    "Start Time": "start_time",
+    "End Time": "end_time",
+    "MSN": "msn",
+}
+
+# Columns of the dataset. The dataset is also partitioned by room, box_range and year (hive-style folder names)
+session_schema = pa.schema([
+    ("subject", pa.string()),
+    ("session_date", pa.date32()),
+    ("start_date", pa.string()),
+    ("end_date", pa.string()),
+    ("start_time", pa.string()),
+    ("end_time", pa.string()),
+    ("experiment", pa.string()),
+    ("group", pa.string()),
+    ("box_number", pa.int32()),
+    ("msn", pa.string()),
+    ("source_file", pa.string()),
+    ("arrays", pa.map_(pa.string(), pa.list_(pa.float64()))),  # Variable name (A-Z) mapped to its values
+]) if pa else None
+
+def is_available():
+    """
+    Check whether pyarrow is installed so the dataset can be written.
+    """
+    return pa is not None
+
+def parse_date(date_str):
+    """
+    Parse a session date, or return None if it is in none of the known formats.
+    """
+    for fmt in ContextRows.date_formats:
+        try:
+            return datetime.strptime(date_str, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def parse_sessions(text):
+    """
+    Parse the session blocks of MED-PC data (one or more day files) into typed records.
+
+    Args:
+        text (str): The data to parse.
+
+    Returns:
+        list: One dictionary per session with the dataset columns (see session_schema).
+    """
+    sessions = []
+    session = None
+    source_file = None
+    array_name = None
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            array_name = None  # Arrays end at an empty line
+            continue
+        if line.lower().startswith("file:"):
+            source_file = line[5:].strip()
+            continue
+
+        name, _, value = line.partition(":")
+        name = name.strip()
+        value = value.strip()
+
+        if name == "Start Date":
+            # Each session block starts with its start date
+            session = {"source_file": source_file, "arrays": {}}
+            sessions.append(session)
+        if session is None:
+            continue
+
+        if name in header_fields:
+            session[header_fields[name]] = value
+            array_name = None
+        elif len(name) == 1 and name.isalpha():
+            # A variable ("A: 0.000") or the start of an array ("C:")
+            array_name = name
+            session["arrays"][array_name] = parse_values(value)
+        elif name.isdigit() and array_name:
+            # A row of an array ("     0:       1.000       2.000 ...")
+            session["arrays"][array_name].extend(parse_values(value))
+
+    for session in sessions:
+        session["session_date"] = parse_date(session.get("start_date", ""))
+        try:
+            session["box_number"] = int(session.get("box_number", ""))
+        except ValueError:
+            session["box_number"] = None
+        session["arrays"] = list(session["arrays"].items())
+    return sessions
+
+def parse_values(value):
+    """
+    Convert the numbers on one line to floats, skipping anything that is not a number.
+    """
+    values = []
+    for token in value.split():
+        try:
+            values.append(float(token))
+        except ValueError:
+            pass
+    return values
+
+def get_partition_path(dataset_dir, room, box_range, year=None):
+    """
+    Return the folder of one box (or one box and year) in the dataset.
+    """
+    partition_path = os.path.join(dataset_dir, f"room={room}", f"box_range={box_range}")
+    if year is not None:
+        partition_path = os.path.join(partition_path, f"year={year}")
+    return partition_path
+
+def remove_box(dataset_dir, room, box_range):
+    """
+    Remove every partition of a box, before the box is written again from the start.
+    """
+    partition_path = get_partition_path(dataset_dir, room, box_range)
+    if os.path.isdir(partition_path):
+        shutil.rmtree(partition_path)
+
+def write_sessions(dataset_dir, room, box_range, year, file_path, part_name):
+    """
+    Parse the sessions in a merged data file and write them as one Parquet file of the dataset.
+
+    Args:
+        dataset_dir (str): Folder of the dataset.
+        room (str): Room of the box.
+        box_range (str): Box range, e.g. "1-16".
+        year (str): Year of the sessions.
+        file_path (str): Merged data to parse.
+        part_name (str): Name of the Parquet file within the partition.
+
+    Returns:
+        int: The number of sessions written.
+    """
+    with open(file_path, "rb") as data_file:
+        sessions = parse_sessions(data_file.read().decode("utf-8", errors="replace"))
+    if not sessions:
+        return 0
+
+    partition_path = get_partition_path(dataset_dir, room, box_range, year)
+    os.makedirs(partition_path, exist_ok=True)
+    table = pa.Table.from_pylist(sessions, schema=session_schema)
+    pq.write_table(table, os.path.join(partition_path, f"{part_name}.parquet"))
+    return len(sessions)
+
+def read_sessions(dataset_dir, subjects=None, start_date=None, end_date=None, rooms=None, box_ranges=None):
+    """
+    Read sessions from the dataset. Only the partitions (room, box range, year) and row groups that can
+    match the filters are read.
+
+    Args:
+        dataset_dir (str): Folder of the dataset.
+        subjects (list): Only these subject IDs, or None for all.
+        start_date (date): Only sessions on or after this date, or None.
+        end_date (date): Only sessions on or before this date, or None.
+        rooms (list): Only these rooms, or None for all.
+        box_ranges (list): Only these box ranges, or None for all.
+
+    Returns:
+        pyarrow.Table: The matching sessions, with the partition columns.
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+    conditions = []
+    if subjects is not None:
+        conditions.append(ds.field("subject").isin([str(subject) for subject in subjects]))
+    if start_date is not None:
+        conditions.append(ds.field("year") >= start_date.year)
+        conditions.append(ds.field("session_date") >= start_date)
+    if end_date is not None:
+        conditions.append(ds.field("year") <= end_date.year)
+        conditions.append(ds.field("session_date") <= end_date)
+    if rooms is not None:
+        conditions.append(ds.field("room").isin(list(rooms)))
+    if box_ranges is not None:
+        conditions.append(ds.field("box_range").isin(list(box_ranges)))
+
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+    return dataset.to_table(filter=row_filter)